@@ -1,8 +1,12 @@
 import os
 import time
 import json
+import queue
 import yaml
 import uuid
+import hashlib
+import threading
+import concurrent.futures
 import logging
 import tempfile
 import requests
@@ -11,6 +15,7 @@ from flask import Flask
 #from flask import _app_ctx_stack
 from flask import abort
 from flask import request
+from flask import g
 from flask import jsonify
 from flask import make_response
 from flask import send_file
@@ -39,9 +44,35 @@ if app.config['DEBUG']:
     app.logger.info(app.config)
     app.logger.info(config)
 
+# graphite renders set their own caching headers
+CACHED_ENDPOINTS = [ 'device_metrics_render', 'device_group_metrics_render' ]
+
+# request instrumentation, see /api/v1/_metrics
+@app.before_request
+def startTimer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observeRequest(r):
+    start = g.get('request_start')
+
+    if start is None:
+        return r
+
+    # the route pattern, not the path, keeps the number of series bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    instrumentation.observe('homeauto_http_request_duration_seconds', time.perf_counter() - start, route = route, method = request.method)
+    instrumentation.inc('homeauto_http_requests_total', route = route, method = request.method, status = r.status_code)
+
+    return r
+
 # never cache
 @app.after_request
 def add_header(r):
+    if request.endpoint in CACHED_ENDPOINTS:
+        return r
+
     r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     r.headers["Pragma"] = "no-cache"
     r.headers["Expires"] = "0"
@@ -49,17 +80,231 @@ def add_header(r):
 
     return r
 
+# graphite render proxy
+RENDER_CHUNK_SIZE = 64 * 1024
+RENDER_HEADERS = [ 'Content-Length', 'Content-Encoding', 'Last-Modified', 'Expires', 'Cache-Control' ]
+
+def openRender(url):
+    # metrics:
+    #   render_timeout: seconds to wait for graphite
+    timeout = Config()['metrics'].get('render_timeout', 10)
+    start = time.perf_counter()
+
+    try:
+        r = httpPool().get(url, stream = True, timeout = (3, timeout))
+    except requests.RequestException as e:
+        instrumentation.observe('homeauto_graphite_render_duration_seconds', time.perf_counter() - start, result = 'error')
+        app.logger.error('graphite render failed ({}): {}'.format(e, url))
+        return None
+
+    instrumentation.observe('homeauto_graphite_render_duration_seconds', time.perf_counter() - start, result = r.status_code)
+
+    if r.status_code != 200:
+        app.logger.error('graphite render failed ({}): {}'.format(r.status_code, url))
+        r.close()
+        return None
+
+    return r
+
+def streamRender(r):
+    # raw (still encoded) chunks, so Content-Length and Content-Encoding stay valid
+    headers = { h: r.headers[h] for h in RENDER_HEADERS if h in r.headers }
+
+    def generate():
+        try:
+            for chunk in r.raw.stream(RENDER_CHUNK_SIZE, decode_content = False):
+                yield chunk
+        finally:
+            r.close()
+
+    return Response(stream_with_context(generate()), content_type = r.headers['content-type'], headers = headers)
+
+def renderResponse(url, target, from_data):
+    cache = renderCache()
+    max_size = Config()['metrics'].get('render_cache', {}).get('max_size', 2 * 1024 * 1024)
+
+    if not cache.ttl:
+        r = openRender(url)
+
+        if not r:
+            abort(make_response(jsonify(message='graphite render failed'), 502))
+
+        return streamRender(r)
+
+    too_large = []
+
+    def fetch():
+        r = openRender(url)
+
+        if not r:
+            return None
+
+        # renders larger than max_size are streamed, not cached
+        if int(r.headers.get('Content-Length', 0)) > max_size:
+            too_large.append(r)
+            return None
+
+        try:
+            return r.headers['content-type'], b''.join(r.iter_content(chunk_size = RENDER_CHUNK_SIZE))
+        finally:
+            r.close()
+
+    entry = cache.get((target, from_data), fetch)
+
+    if too_large:
+        return streamRender(too_large[0])
+
+    if not entry:
+        abort(make_response(jsonify(message='graphite render failed'), 502))
+
+    if request.if_none_match.contains(entry['etag']):
+        r = Response(status = 304)
+    else:
+        r = Response(entry['body'], content_type = entry['content_type'])
+
+    r.set_etag(entry['etag'])
+    r.cache_control.public = True
+    r.cache_control.max_age = max(0, int(entry['expires'] - time.monotonic()))
+
+    return r
+
+# device actions of POST /api/v1/actions
+action_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 16, thread_name_prefix = 'action')
+
+def parseAction(device, data):
+    # returns action, msg, error
+    action = data.get('action')
+    msg = data.get('msg', {})
+
+    # try to make msg an integer
+    try:
+        msg = int(msg)
+    except:
+        pass
+
+    if not action:
+        return None, None, { 'message': 'malformed payload' }
+
+    if action not in device.actions:
+        return None, None, { 'message': 'action not allowed', 'actions': device.actions }
+
+    return action, msg, None
+
+# one lock per device name, actions on the same (resident) device run one after another
+action_locks = {}
+action_locks_lock = threading.Lock()
+
+def actionLock(name):
+    with action_locks_lock:
+        return action_locks.setdefault(name, threading.Lock())
+
+def timedAction(device, action, msg):
+    with actionLock(device.name):
+        start = time.monotonic()
+        data = device.action(action, msg)
+        duration = time.monotonic() - start
+
+    instrumentation.observe('homeauto_device_action_duration_seconds', duration, device = device.name, action = action)
+
+    return data, duration
+
+# uplinks of POST /api/v1/lora/webhook, processed in the background by loraConsumer()
+lora_queue = queue.Queue(maxsize = config.get('lora', {}).get('queue_size', 1000))
+lora_stats = { 'received': 0, 'processed': 0, 'dropped': 0, 'unknown_device': 0, 'failed': 0 }
+lora_consumer = None
+lora_consumer_lock = threading.Lock()
+
+def loraConsumer():
+    while True:
+        lora_id, data = lora_queue.get()
+
+        try:
+            name = registry.index('device_id', 'lora').get(lora_id)
+
+            if not name:
+                lora_stats['unknown_device'] += 1
+                app.logger.error('Received payload wihout matching device: ' + str(json.dumps(data, indent=2)))
+                continue
+
+            registry.get(name).receiveMsg(data)
+            lora_stats['processed'] += 1
+        except Exception as e:
+            lora_stats['failed'] += 1
+            app.logger.error('processing uplink of {} failed: {}'.format(lora_id, e))
+        finally:
+            lora_queue.task_done()
+
+def startLoraConsumer():
+    global lora_consumer
+
+    if lora_consumer is not None and lora_consumer.is_alive():
+        return
+
+    with lora_consumer_lock:
+        if lora_consumer is None or not lora_consumer.is_alive():
+            lora_consumer = threading.Thread(target = loraConsumer, name = 'lora', daemon = True)
+            lora_consumer.start()
+
+def loraStats():
+    return dict(lora_stats, queue_depth = lora_queue.qsize(), queue_size = lora_queue.maxsize)
+
+@instrumentation.collector
+def loraSamples():
+    samples = [ ('homeauto_lora_queue_depth', {}, lora_queue.qsize()) ]
+
+    for result, value in lora_stats.items():
+        samples.append(('homeauto_lora_uplinks_total', { 'result': result }, value))
+
+    return samples
+
+def refreshRequested():
+    # live device polls are opt-in: ?refresh=true
+    return request.args.get('refresh', '').lower() in [ '1', 'true', 'yes' ]
+
+def notModified(etag):
+    r = Response(status = 304)
+    r.set_etag(etag)
+
+    return r
+
+def projectFields(data, fields):
+    # keeps only the given fields, nested fields are separated by a dot (last_update.human)
+    if not fields:
+        return data
+
+    projected = {}
+
+    for field in fields:
+        value = data
+        keys = field.split('.')
+
+        for k in keys:
+            if not isinstance(value, dict) or k not in value:
+                break
+
+            value = value[k]
+        else:
+            target = projected
+
+            for k in keys[:-1]:
+                target = target.setdefault(k, {})
+
+            target[keys[-1]] = value
+
+    return projected
+
 ##
 # routes
 ##
 # ui files
 @app.route('/')
 def ui_index():
+    config = Config()
     from_data = request.args.get('from')
     if not from_data:
         from_data = "-1days"
 
-    devices, _ = loadDevices()
+    devices = registry.all(refresh=refreshRequested())
 
     return render_template(
         "index.html",
@@ -70,29 +315,17 @@ def ui_index():
 
 @app.route('/details/<device>')
 def ui_details(device):
-    metrics = []
     from_data = request.args.get('from')
     if not from_data:
         from_data = "-1days"
 
-    url = "{}/metrics/find?query={}.{}.*".format(
-        config['metrics']['render_api_base_url'],
-        config['metrics']['prefix'],
-        device
-    )
-
-    r = requests.get(url, timeout=3)
-    #if r.status_code != 200:
-    #    data = {
-    #        "status": "error",
-    #        "data": r.text()
-    #    }
+    if device not in Config()['devices']:
+        abort(make_response(jsonify(message='device not found!'), 404))
 
-    if r.status_code == 200:
-        for m in r.json():
-            metrics.append(m['text'])
+    # cached, graphite being slow or down does not block the page
+    metrics = metricCatalog().get(device) or []
 
-    device_data = loadDevice(device)
+    device_data = registry.get(device, refresh=refreshRequested())
 
     return render_template(
         "details.html",
@@ -111,124 +344,282 @@ def ui(filename=None):
 
 @app.route('/api/v1/devices')
 def show_devices():
-    data = []
-    devices, _ = loadDevices()
+    # ?expand=1 returns the state of all devices by name instead of only the names,
+    # ?fields=name,state,last_update.human limits the returned fields
+    devices = registry.all(refresh=refreshRequested())
+
+    if request.args.get('expand', '').lower() not in [ '1', 'true', 'yes' ]:
+        return jsonify(list(devices.keys()))
 
-    for d in devices.keys():
-        data.append(devices[d].__dict__)
+    fields = [ f for f in request.args.get('fields', '').split(',') if f ]
 
-    return jsonify(list(devices.keys()))
+    etag = hashlib.sha1(request.query_string + ''.join(device.etag() for device in devices.values()).encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        return notModified(etag)
+
+    r = jsonify({ name: projectFields(device.__dict__, fields) for name, device in devices.items() })
+    r.set_etag(etag)
+
+    return r
 
 @app.route('/api/v1/devices/<device>', methods = [ 'GET', 'POST' ])
 def show_device(device):
-    device = loadDevice(device)
+    device = registry.get(device, refresh=request.method == 'GET' and refreshRequested())
     if not device:
         abort(make_response(jsonify(message='device not found!'), 404))
 
     if request.method == 'GET':
-        return jsonify(device.__dict__)
+        etag = device.etag()
+
+        if request.if_none_match.contains(etag):
+            return notModified(etag)
+
+        r = jsonify(device.__dict__)
+        r.set_etag(etag)
+
+        return r
 
     if request.method == 'POST':
         data = request.get_json(force=True)
         print(data)
-        action = data.get('action')
-        msg = data.get('msg', {})
+        action, msg, error = parseAction(device, data)
+
+        if error:
+            abort(make_response(jsonify(error), 400))
+
+        data, duration = timedAction(device, action, msg)
+
+        return jsonify(data)
+
+@app.route('/api/v1/actions', methods = [ 'POST' ])
+def batch_actions():
+    # runs several device actions at once:
+    #   { "actions": [ { "device": "office1", "action": "on" }, ... ] }
+    #   { "device_group": "temperature", "action": "on", "msg": {} }
+    # both can be combined, "timeout" (seconds) bounds the whole batch
+    config = Config()
+    data = request.get_json(force=True)
+
+    if type(data) != dict:
+        abort(make_response(jsonify(message='malformed payload'), 400))
+
+    if type(data.get('actions', [])) != list:
+        abort(make_response(jsonify(message='malformed payload, actions must be a list'), 400))
+
+    items = list(data.get('actions', []))
+
+    if data.get('device_group'):
+        device_group = config['device_groups'].get(data['device_group'])
+
+        if not device_group:
+            abort(make_response(jsonify(message='device group not found!'), 404))
+
+        for d in device_group['devices']:
+            items.append({ 'device': d, 'action': data.get('action'), 'msg': data.get('msg', {}) })
+
+    if not items:
+        abort(make_response(jsonify(message='malformed payload, no actions'), 400))
+
+    try:
+        timeout = float(data.get('timeout', config.get('actions', {}).get('timeout', 10)))
+    except (TypeError, ValueError):
+        timeout = None
 
-        # try to make msg an integer
+    # also rejects nan
+    if timeout is None or not timeout > 0:
+        abort(make_response(jsonify(message='malformed payload, timeout must be a positive number'), 400))
+
+    timeout = min(timeout, 60)
+    start = time.monotonic()
+    results = []
+    futures = {}
+
+    for item in items:
+        if type(item) != dict:
+            results.append({ 'status': 'error', 'result': 'malformed action' })
+            continue
+
+        result = { 'device': item.get('device'), 'action': item.get('action') }
+        results.append(result)
+
+        if type(item.get('device')) != str:
+            result.update(status = 'error', result = 'malformed device')
+            continue
+
+        device = registry.get(item['device'])
+
+        if not device:
+            result.update(status = 'error', result = 'device not found!')
+            continue
+
+        action, msg, error = parseAction(device, item)
+
+        if error:
+            result.update(status = 'error', result = error)
+            continue
+
+        futures[action_executor.submit(timedAction, device, action, msg)] = result
+
+    done, not_done = concurrent.futures.wait(futures, timeout = timeout)
+
+    for f in done:
         try:
-            msg = int(msg)
-        except:
-            pass
+            out, duration = f.result()
+            futures[f].update(status = 'ok', result = out, duration = duration)
+        except Exception as e:
+            app.logger.error('action {} on {} failed: {}'.format(futures[f]['action'], futures[f]['device'], e))
+            futures[f].update(status = 'error', result = str(e))
+
+    # still running, their result is not waited for
+    for f in not_done:
+        futures[f].update(status = 'timeout', result = 'no result within {}s'.format(timeout))
+
+    return jsonify({
+        'results': results,
+        'duration': time.monotonic() - start
+    })
+
+@app.route('/api/v1/events')
+def show_events():
+    # server-sent events with the changed fields of every device state update
+    # filter: ?device=<name>[,<name>...] and/or ?group=<device_group>
+    config = Config()
+    devices = set()
+
+    if request.args.get('device'):
+        devices.update(request.args['device'].split(','))
+
+    if request.args.get('group'):
+        device_group = config['device_groups'].get(request.args['group'])
+
+        if not device_group:
+            abort(make_response(jsonify(message='device group not found!'), 404))
 
-        if not action:
-            abort(make_response(jsonify(message='malformed payload'), 400))
+        devices.update(device_group['devices'])
 
-        if action not in device.actions:
-            abort(make_response(
-                jsonify(
-                    message = 'action not allowed',
-                    actions = device.actions
-                ), 400)
-            )
+    hub = stateEventHub('api')
+    subscription = hub.subscribe()
 
-        return jsonify(device.action(action, msg))
+    if subscription is None:
+        # another app process holds the listener, see state_events in config.example.yml
+        response = make_response(jsonify(message='state events are not available in this process!'), 503)
+        response.headers['Retry-After'] = str(STATE_EVENT_RETRY)
+        abort(response)
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+
+            while True:
+                try:
+                    event = subscription.get(timeout = 15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if devices and event['device'] not in devices:
+                    continue
+
+                yield 'id: {}\nevent: state\ndata: {}\n\n'.format(event['id'], json.dumps(event))
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(stream_with_context(stream()), mimetype = 'text/event-stream', headers = { 'X-Accel-Buffering': 'no' })
+
+@app.route('/api/v1/stats')
+def show_stats():
+    return jsonify({
+        'config': config_stats,
+        'state_store': state_stats,
+        'mqtt': mqttStats(),
+        'http': httpPool().stats(),
+        'render_cache': render_cache_stats,
+        'lora': loraStats(),
+        'state_events': stateEventStats()
+    })
+
+@app.route('/api/v1/_metrics')
+def show_metrics():
+    # prometheus text format, workers expose the same via instrumentation.textfile_directory/ports
+    return Response(instrumentation.render({ 'process': 'app' }), content_type = 'text/plain; version=0.0.4')
 
 @app.route('/api/v1/devices/<device>/metrics', methods = [ 'GET' ])
 def device_metrics(device):
-    url = "{}/metrics/find?query={}.{}.*".format(
-        config['metrics']['render_api_base_url'],
-        config['metrics']['prefix'],
-        device
-    )
-
-    r = requests.get(url, timeout=3)
-    if r.status_code != 200:
-        data = {
-            "status": "error",
-            "data": r.text()
-        }
+    # the catalog keeps an entry per name, only configured devices get one
+    if device not in Config()['devices']:
+        abort(make_response(jsonify(message='device not found!'), 404))
 
-    if r.status_code == 200:
-        data = []
+    data = metricCatalog().get(device)
 
-        for m in r.json():
-            data.append(m['text'])
+    if data is None:
+        return jsonify({
+            "status": "error",
+            "data": "graphite metrics/find failed"
+        }), 502
 
     return jsonify(data)
 
 @app.route('/api/v1/device_groups/<device_group_name>/metrics/<metric>', methods = [ 'GET' ])
 def device_group_metrics_render(device_group_name, metric):
+    config = Config()
     from_data = request.args.get('from')
 
     if not from_data:
         from_data = "-1days"
 
+    from_data = from_data.strip().lower()
+
     device_group = config['device_groups'][device_group_name]
     device_list = ','.join(device_group['devices'])
+    target = "%s.{%s}.%s"%(config['metrics']['prefix'], device_list, metric)
 
-    url = "%s/render/?target=aliasByNode(cactiStyle(aliasByNode(%s.{%s}.%s,1)),3)&from=%s&height=400&width=800&title=%s&bgcolor=white&fgcolor=black&drawNullAsZero=false&lineMode=connected&colorList=green,blue,yellow,black,purple,orange,red,darkgrey,rose,magenta&yMin=0"%(
+    url = "%s/render/?target=aliasByNode(cactiStyle(aliasByNode(%s,1)),3)&from=%s&height=400&width=800&title=%s&bgcolor=white&fgcolor=black&drawNullAsZero=false&lineMode=connected&colorList=green,blue,yellow,black,purple,orange,red,darkgrey,rose,magenta&yMin=0"%(
         config['metrics']['render_api_base_url'],
-        config['metrics']['prefix'],
-        device_list,
-        metric,
+        target,
         from_data,
         metric
     )
 
-    r = requests.get(url, stream = True)
-    return Response(stream_with_context(r.iter_content()), content_type = r.headers['content-type'])
+    return renderResponse(url, 'group:' + target, from_data)
 
 @app.route('/api/v1/devices/<device>/metrics/<metric>', methods = [ 'GET' ])
 def device_metrics_render(device, metric):
+    config = Config()
     from_data = request.args.get('from')
 
     if not from_data:
         from_data = "-1days"
 
-    url = "{}/render/?target=aliasByNode(cactiStyle(aliasByNode({}.{}.{},-1)),1)&from={}&height=400&width=800&title={}&bgcolor=white&fgcolor=black&drawNullAsZero=false&lineMode=connected&colorList=green&yMin=0".format(
+    from_data = from_data.strip().lower()
+    target = "{}.{}.{}".format(config['metrics']['prefix'], device, metric)
+
+    url = "{}/render/?target=aliasByNode(cactiStyle(aliasByNode({},-1)),1)&from={}&height=400&width=800&title={}&bgcolor=white&fgcolor=black&drawNullAsZero=false&lineMode=connected&colorList=green&yMin=0".format(
         config['metrics']['render_api_base_url'],
-        config['metrics']['prefix'],
-        device,
-        metric,
+        target,
         from_data,
         metric
     )
 
-    r = requests.get(url, stream = True)
-    return Response(stream_with_context(r.iter_content()), content_type = r.headers['content-type'])
+    return renderResponse(url, 'device:' + target, from_data)
 
 @app.route('/api/v1/lora/webhook', methods = [ 'POST' ])
 def lora_webhook():
+    data = request.get_json(force=True, silent=True)
+
+    if not isinstance(data, dict):
+        app.logger.info('Received invalid payload: ' + str(request.get_data()[:1024]))
+        return jsonify({}), 400
+
     headers={}
-    data = request.get_json(force=True)
     for i in request.headers:
         headers[i[0]] = i[1]
     data['headers'] = headers
 
 
     lora_id = None
-    if data.get('end_device_ids'):
-        if data['end_device_ids']['device_id']:
+    if isinstance(data.get('end_device_ids'), dict):
+        if data['end_device_ids'].get('device_id'):
             lora_id = data['end_device_ids']['device_id']
 
     if not lora_id:
@@ -243,17 +634,16 @@ def lora_webhook():
         app.logger.error('Received payload wihout uplink_message.decoded_payload: ' + str(json.dumps(data, indent=2)))
         return jsonify({})
 
-    device = None
-    devices, lora_devices = loadDevices('lora')
-    for d in lora_devices:
-        if lora_id == devices[d].device_id:
-            device = loadDevice(d)
+    startLoraConsumer()
 
-    if not device:
-        app.logger.error('Received payload wihout matching device: ' + str(json.dumps(data, indent=2)))
-        return jsonify({})
+    try:
+        lora_queue.put_nowait((lora_id, data))
+    except queue.Full:
+        lora_stats['dropped'] += 1
+        app.logger.error('LoRa queue is full, dropped uplink of {}'.format(lora_id))
+        return jsonify({}), 503
 
-    device.receiveMsg(data)
-    return jsonify({})
+    lora_stats['received'] += 1
+    return jsonify({}), 202
 
 # vim: set syntax=python:
@@ -0,0 +1,56 @@
+#!/bin/python
+# Counts YAML parses per simulated request (loadDevice + save + logger lookups)
+# against a generated config with many devices.
+#
+#   python bench/config_parse.py [devices] [requests]
+import os
+import sys
+import time
+import tempfile
+
+tmp = tempfile.mkdtemp(prefix='homeauto-bench-')
+os.environ['HOMEAUTO_CONFIG'] = tmp
+
+num_devices = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+with open(tmp + '/config.yml', 'w') as f:
+    f.write('storage_directory: {}/store/\n'.format(tmp))
+    f.write('devices:\n')
+
+    for i in range(num_devices):
+        f.write('  lamp{}:\n    type: ikea_lamp\n    zigbee_id: "0x{:016x}"\n    metrics: true\n'.format(i, i))
+
+os.makedirs(tmp + '/store')
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from utils import *
+
+def request():
+    device = loadDevice('lamp0')
+    device.save()
+
+    return device
+
+# warm up, first call parses the config
+request()
+
+parses = config_stats['parses']
+start = time.perf_counter()
+
+for i in range(num_requests):
+    request()
+
+elapsed = time.perf_counter() - start
+parses = config_stats['parses'] - parses
+
+print('devices: {}, requests: {}'.format(num_devices, num_requests))
+print('config parses per request: {:.3f}'.format(parses / num_requests))
+print('time per request: {:.3f} ms'.format(elapsed / num_requests * 1000))
+print('config stats: {}'.format(config_stats))
+
+# touching the file invalidates the snapshot
+time.sleep(CONFIG_CHECK_INTERVAL)
+os.utime(tmp + '/config.yml')
+request()
+print('parses after touching config.yml: {}'.format(config_stats['parses']))
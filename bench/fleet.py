@@ -0,0 +1,381 @@
+#!/bin/python
+# End-to-end load test with a simulated device fleet. Starts app.py,
+# worker_zigbee.py, worker_http.py and worker_graphite.py against local
+# stand-ins (bench/standins.py):
+#
+#  - an mqtt broker publishing zigbee2mqtt-style state messages for --zigbee devices
+#  - --http volumio/mystrom endpoints with --http-latency and --http-failure-rate
+#  - a lora webhook generator posting ttn uplinks to app.py
+#  - --clients api clients hammering the flask api
+#
+# and reports p50/p99 latency and throughput of the api plus cpu and rss per process.
+#
+#   python bench/fleet.py [--zigbee 500] [--http 50] [--duration 30] [--output fleet.json]
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import requests
+import standins
+
+root = os.path.abspath(os.path.join(sys.path[0], '..'))
+
+PROCESSES = [ 'app', 'worker_zigbee', 'worker_http', 'worker_graphite' ]
+
+def freePort(kind=socket.SOCK_STREAM):
+    s = socket.socket(socket.AF_INET, kind)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+def percentile(values, p):
+    if not values:
+        return 0
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+##
+# Fleet
+##
+
+def fleetConfig(args, broker, graphite, http_devices):
+    devices = {}
+
+    for i in range(args.zigbee):
+        # mostly sensors, every fifth device is a lamp
+        devices['zb{}'.format(i)] = {
+            'type': 'ikea_lamp' if i % 5 == 0 else 'zigbee_log',
+            'zigbee_id': '0x{:016x}'.format(i),
+            'metrics': True,
+        }
+
+    for i, server in enumerate(http_devices):
+        devices['http{}'.format(i)] = {
+            'type': 'volumio' if i % 2 else 'mystrom_switch',
+            'address': server.address,
+            'metrics': True,
+        }
+
+    for i in range(args.lora):
+        devices['lora{}'.format(i)] = { 'type': 'lora_log', 'device_id': 'eui-{:04d}'.format(i), 'metrics': True }
+
+    return {
+        'zigbee2mqtt': { 'server': '127.0.0.1', 'port': broker.port, 'topic': 'zigbee2mqtt' },
+        'metrics': {
+            'server': '127.0.0.1',
+            'port': graphite.carbon_port,
+            'prefix': 'homeautomation',
+            'render_api_base_url': graphite.render_url,
+            'timeout': 5,
+        },
+        'http_worker': { 'interval': args.http_interval, 'timeout': 5, 'workers': 8 },
+        'state_events': {
+            'listeners': {
+                'metrics': '127.0.0.1:{}'.format(freePort(socket.SOCK_DGRAM)),
+                'api': '127.0.0.1:{}'.format(freePort(socket.SOCK_DGRAM)),
+            }
+        },
+        'devices': devices,
+        'device_groups': { 'lamps': { 'devices': [ name for name, d in devices.items() if d['type'] == 'ikea_lamp' ][:10] } },
+    }
+
+def startProcesses(directory, app_port):
+    env = dict(os.environ, HOMEAUTO_CONFIG=directory, PYTHONUNBUFFERED='1')
+    processes = {}
+
+    for name in PROCESSES:
+        if name == 'app':
+            cmd = [ sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(app_port), '--with-threads' ]
+        else:
+            cmd = [ sys.executable, name + '.py' ]
+
+        log = open(os.path.join(directory, name + '.log'), 'w')
+        processes[name] = subprocess.Popen(cmd, cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    return processes
+
+def waitFor(check, timeout, what):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except requests.RequestException:
+            pass
+
+        time.sleep(0.1)
+
+    raise RuntimeError('{} did not come up within {}s'.format(what, timeout))
+
+##
+# Traffic
+##
+
+def paced(rate, stop, func):
+    # calls func() rate times per second until stop is set
+    interval = 1 / rate
+    next_call = time.monotonic()
+
+    while not stop.is_set():
+        func()
+
+        next_call += interval
+        delay = next_call - time.monotonic()
+
+        if delay > 0:
+            stop.wait(delay)
+
+def zigbeeTraffic(broker, args, stop, stats):
+    def publish():
+        i = random.randrange(args.zigbee)
+
+        if i % 5 == 0:
+            payload = { 'state': random.choice([ 'ON', 'OFF' ]), 'brightness': random.randint(1, 254), 'linkquality': random.randint(50, 150) }
+        else:
+            payload = { 'temperature': round(random.uniform(18, 24), 1), 'humidity': random.randint(30, 60), 'battery': 90, 'linkquality': random.randint(50, 150) }
+
+        broker.publish('zigbee2mqtt/0x{:016x}'.format(i), payload)
+        stats['zigbee_published'] += 1
+
+    paced(args.zigbee_rate, stop, publish)
+
+def loraTraffic(base_url, args, stop, stats):
+    session = requests.Session()
+
+    def post():
+        payload = {
+            'end_device_ids': { 'device_id': 'eui-{:04d}'.format(random.randrange(args.lora)) },
+            'uplink_message': { 'decoded_payload': { 'TempC_SHT': round(random.uniform(-5, 30), 2), 'Hum_SHT': random.randint(20, 90), 'BatV': 3.1 } },
+        }
+
+        start = time.perf_counter()
+
+        try:
+            r = session.post(base_url + '/api/v1/lora/webhook', json=payload, timeout=10)
+            status = r.status_code
+        except requests.RequestException:
+            status = 'error'
+
+        stats['lora'].append((time.perf_counter() - start, status))
+
+    paced(args.lora_rate, stop, post)
+
+def apiClient(base_url, args, stop, results):
+    # request mix of the ui and cli.py
+    session = requests.Session()
+    lamps = [ 'zb{}'.format(i) for i in range(0, args.zigbee, 5) ]
+
+    while not stop.is_set():
+        r = random.random()
+
+        if r < 0.5:
+            kind, method, path, body = 'device', 'GET', '/api/v1/devices/zb{}'.format(random.randrange(args.zigbee)), None
+        elif r < 0.7:
+            kind, method, path, body = 'devices', 'GET', '/api/v1/devices', None
+        elif r < 0.85:
+            kind, method, path, body = 'devices_expand', 'GET', '/api/v1/devices?expand=1&fields=temperature,state,last_update', None
+        elif r < 0.95 or not lamps:
+            kind, method, path, body = 'stats', 'GET', '/api/v1/stats', None
+        else:
+            kind, method, path, body = 'action', 'POST', '/api/v1/devices/' + random.choice(lamps), { 'action': 'toggle' }
+
+        start = time.perf_counter()
+
+        try:
+            status = session.request(method, base_url + path, json=body, timeout=30).status_code
+        except requests.RequestException:
+            status = 'error'
+
+        results.append((kind, time.perf_counter() - start, status))
+
+##
+# Resource usage
+##
+
+def cpuSeconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+
+    # utime and stime, fields 14 and 15 of proc(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def rssBytes(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+def sampleResources(processes, stop, usage):
+    while not stop.is_set():
+        for name, p in processes.items():
+            try:
+                rss = rssBytes(p.pid)
+            except OSError:
+                continue
+
+            usage[name]['rss_max'] = max(usage[name]['rss_max'], rss)
+            usage[name]['rss_last'] = rss
+
+        stop.wait(1)
+
+##
+# Main
+##
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zigbee', type=int, default=500, help='zigbee devices')
+    parser.add_argument('--http', type=int, default=50, help='http devices (volumio/mystrom)')
+    parser.add_argument('--lora', type=int, default=20, help='lora devices')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--zigbee-rate', type=float, default=200, help='zigbee messages per second (all devices)')
+    parser.add_argument('--lora-rate', type=float, default=5, help='lora uplinks per second')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent api clients')
+    parser.add_argument('--http-interval', type=float, default=2, help='http_worker.interval')
+    parser.add_argument('--http-latency', type=float, default=0.05, help='mean response time of the http devices in seconds')
+    parser.add_argument('--http-failure-rate', type=float, default=0.02, help='share of http device requests answered with 500')
+    parser.add_argument('--output', help='save the report as json')
+    args = parser.parse_args()
+
+    broker = standins.MqttBroker().start()
+    graphite = standins.GraphiteServer().start()
+    http_devices = [ standins.DeviceServer(latency=args.http_latency, failure_rate=args.http_failure_rate).start() for i in range(args.http) ]
+
+    directory = standins.writeConfig(fleetConfig(args, broker, graphite, http_devices))
+    app_port = freePort()
+    base_url = 'http://127.0.0.1:{}'.format(app_port)
+
+    print('fleet: {} zigbee, {} http, {} lora devices, config and logs in {}'.format(args.zigbee, args.http, args.lora, directory))
+
+    processes = startProcesses(directory, app_port)
+
+    try:
+        waitFor(lambda: requests.get(base_url + '/api/v1/stats', timeout=1).ok, 30, 'app.py')
+        waitFor(lambda: broker.subscribers() > 0, 30, 'worker_zigbee.py')
+
+        stop = threading.Event()
+        stats = { 'zigbee_published': 0, 'lora': [] }
+        results = []
+        usage = { name: { 'rss_max': 0, 'rss_last': 0 } for name in processes }
+        cpu_start = { name: cpuSeconds(p.pid) for name, p in processes.items() }
+
+        threads = [
+            threading.Thread(target=zigbeeTraffic, args=(broker, args, stop, stats), daemon=True),
+            threading.Thread(target=sampleResources, args=(processes, stop, usage), daemon=True),
+        ]
+
+        if args.lora and args.lora_rate:
+            threads.append(threading.Thread(target=loraTraffic, args=(base_url, args, stop, stats), daemon=True))
+
+        for i in range(args.clients):
+            threads.append(threading.Thread(target=apiClient, args=(base_url, args, stop, results), daemon=True))
+
+        start = time.monotonic()
+
+        for t in threads:
+            t.start()
+
+        stop.wait(args.duration)
+        stop.set()
+
+        for t in threads:
+            t.join(30)
+
+        elapsed = time.monotonic() - start
+
+        for name, p in processes.items():
+            usage[name]['cpu_percent'] = round((cpuSeconds(p.pid) - cpu_start[name]) / elapsed * 100, 1)
+
+        app_stats = requests.get(base_url + '/api/v1/stats', timeout=10).json()
+    finally:
+        # SIGTERM lets the processes flush their state (atexit)
+        for p in processes.values():
+            p.send_signal(signal.SIGTERM)
+
+        for p in processes.values():
+            try:
+                p.wait(10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    report = {
+        'args': vars(args),
+        'elapsed': round(elapsed, 2),
+        'api': {},
+        'lora': {},
+        'processes': usage,
+        'standins': {
+            'mqtt': broker.stats,
+            'zigbee_published': stats['zigbee_published'],
+            'http_devices': {
+                'requests': sum(s.stats['requests'] for s in http_devices),
+                'failures': sum(s.stats['failures'] for s in http_devices),
+            },
+            'graphite': graphite.stats,
+        },
+        'app_stats': { k: app_stats.get(k) for k in [ 'lora', 'state_store', 'mqtt' ] },
+    }
+
+    print('')
+    print('{:<16} {:>8} {:>10} {:>10} {:>10} {:>8}'.format('api', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+
+    for kind in sorted(set(r[0] for r in results)) + [ 'total' ]:
+        selected = [ r for r in results if kind == 'total' or r[0] == kind ]
+        latencies = [ r[1] for r in selected ]
+        errors = len([ r for r in selected if r[2] == 'error' or r[2] >= 400 ])
+
+        report['api'][kind] = {
+            'requests': len(selected),
+            'throughput': round(len(selected) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'errors': errors,
+        }
+
+        r = report['api'][kind]
+        print('{:<16} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>8}'.format(kind, r['requests'], r['throughput'], r['p50_ms'], r['p99_ms'], r['errors']))
+
+    latencies = [ l for l, status in stats['lora'] ]
+    report['lora'] = {
+        'uplinks': len(stats['lora']),
+        'accepted': len([ s for l, s in stats['lora'] if s == 202 ]),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+    print('')
+    print('lora webhook: {uplinks} uplinks, {accepted} accepted, p50 {p50_ms} ms, p99 {p99_ms} ms'.format(**report['lora']))
+    print('zigbee: {} messages published, {} delivered to worker_zigbee'.format(stats['zigbee_published'], broker.stats['delivered']))
+    print('http devices: {requests} requests, {failures} injected failures'.format(**report['standins']['http_devices']))
+    print('graphite: {} metrics received'.format(graphite.stats['metrics']))
+
+    print('')
+    print('{:<16} {:>8} {:>12} {:>12}'.format('process', 'cpu %', 'rss max MB', 'rss end MB'))
+
+    for name in PROCESSES:
+        u = usage[name]
+        print('{:<16} {:>8} {:>12.1f} {:>12.1f}'.format(name, u.get('cpu_percent', 0), u['rss_max'] / 2 ** 20, u['rss_last'] / 2 ** 20))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        print('saved to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/bin/python
+# Proxy overhead per graphite render: the old proxy (requests.get + one byte
+# per chunk) against the streaming proxy of app.py, both with the render cache
+# disabled, against a local graphite stand-in serving a fixed png.
+#
+#   python bench/render_proxy.py [renders] [png size in bytes]
+import os
+import sys
+import time
+import tempfile
+import threading
+import http.server
+
+num_renders = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+png_size = int(sys.argv[2]) if len(sys.argv) > 2 else 60 * 1024
+
+png = b'\x89PNG\r\n\x1a\n' + os.urandom(png_size)
+
+class GraphiteHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, *args):
+        pass
+
+graphite = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GraphiteHandler)
+threading.Thread(target=graphite.serve_forever, daemon=True).start()
+
+tmp = tempfile.mkdtemp(prefix='homeauto-bench-')
+os.environ['HOMEAUTO_CONFIG'] = tmp
+os.makedirs(tmp + '/store')
+
+with open(tmp + '/config.yml', 'w') as f:
+    f.write('storage_directory: {}/store/\n'.format(tmp))
+    f.write('metrics:\n')
+    f.write('  render_api_base_url: http://127.0.0.1:{}\n'.format(graphite.server_port))
+    f.write('  prefix: homeautomation\n')
+    f.write('  render_cache:\n    ttl: 0\n')
+    f.write('devices:\n  temp1:\n    type: zigbee_log\n')
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import requests
+from flask import Response
+from flask import stream_with_context
+from app import app
+from app import RENDER_CHUNK_SIZE
+
+# the proxy as it was before
+@app.route('/bench/before/<device>/<metric>')
+def before(device, metric):
+    url = 'http://127.0.0.1:{}/render/?target={}.{}'.format(graphite.server_port, device, metric)
+    r = requests.get(url, stream = True)
+
+    return Response(stream_with_context(r.iter_content()), content_type = r.headers['content-type'])
+
+def measure(path):
+    client = app.test_client()
+
+    # warm up
+    client.get(path).data
+
+    start = time.perf_counter()
+
+    for i in range(num_renders):
+        r = client.get(path)
+        assert len(r.data) == len(png)
+
+    return (time.perf_counter() - start) / num_renders
+
+before_time = measure('/bench/before/temp1/temperature')
+after_time = measure('/api/v1/devices/temp1/metrics/temperature')
+
+print('renders: {}, png size: {} bytes'.format(num_renders, len(png)))
+print('before (iter_content(), 1 byte chunks): {:.2f} ms per render'.format(before_time * 1000))
+print('after (streaming proxy, {} byte chunks): {:.2f} ms per render'.format(RENDER_CHUNK_SIZE, after_time * 1000))
+print('speedup: {:.1f}x'.format(before_time / after_time))
@@ -0,0 +1,416 @@
+# Local stand-ins for the services the home automation talks to, used by the
+# benchmarks and the fleet simulator. Everything listens on 127.0.0.1 with a
+# port picked by the os (port=0), the actual port is in .port after start().
+import os
+import json
+import time
+import yaml
+import types
+import random
+import struct
+import asyncio
+import tempfile
+import threading
+import socketserver
+import http.server
+import urllib.parse
+
+##
+# MQTT
+##
+
+def topicMatches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+
+        if i >= len(topic_parts):
+            return False
+
+        if part != '+' and part != topic_parts[i]:
+            return False
+
+    return len(filter_parts) == len(topic_parts)
+
+def mqttPacket(header, body):
+    length = len(body)
+    encoded = bytearray()
+
+    while True:
+        b = length % 128
+        length //= 128
+
+        if length:
+            b |= 128
+
+        encoded.append(b)
+
+        if not length:
+            break
+
+    return bytes([ header ]) + bytes(encoded) + body
+
+def mqttPublishPacket(topic, payload):
+    topic = topic.encode()
+
+    return mqttPacket(0x30, struct.pack('!H', len(topic)) + topic + payload)
+
+class MqttBroker():
+    # mqtt 3.1.1 subset: connect, publish with qos 0 and 1, subscribe with
+    # + and # wildcards, ping and disconnect. runs its own event loop in a thread,
+    # publish() can be called from any thread.
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.subscriptions = {}
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.stats = { 'connections': 0, 'received': 0, 'delivered': 0 }
+        self.received = {}
+
+    def start(self):
+        threading.Thread(target=self.run, name='mqtt-broker', daemon=True).start()
+        self.ready.wait()
+
+        return self
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+
+        server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+
+        self.loop.run_forever()
+
+    async def readPacket(self, reader):
+        header = (await reader.readexactly(1))[0]
+        multiplier = 1
+        length = 0
+
+        while True:
+            b = (await reader.readexactly(1))[0]
+            length += (b & 127) * multiplier
+            multiplier *= 128
+
+            if not b & 128:
+                break
+
+        return header, await reader.readexactly(length)
+
+    async def handle(self, reader, writer):
+        self.subscriptions[writer] = []
+        self.stats['connections'] += 1
+
+        try:
+            while True:
+                header, body = await self.readPacket(reader)
+                packet_type = header >> 4
+
+                # connect
+                if packet_type == 1:
+                    writer.write(mqttPacket(0x20, b'\0\0'))
+
+                # publish
+                if packet_type == 3:
+                    qos = (header >> 1) & 3
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    payload = body[2 + topic_length:]
+
+                    if qos:
+                        writer.write(mqttPacket(0x40, payload[:2]))
+                        payload = payload[2:]
+
+                    self.stats['received'] += 1
+                    self.received[topic] = self.received.get(topic, 0) + 1
+                    self.route(topic, payload)
+
+                # subscribe
+                if packet_type == 8:
+                    i = 2
+                    granted = b''
+
+                    while i < len(body):
+                        length = struct.unpack('!H', body[i:i + 2])[0]
+                        self.subscriptions[writer].append(body[i + 2:i + 2 + length].decode())
+                        granted += b'\0'
+                        i += 3 + length
+
+                    writer.write(mqttPacket(0x90, body[:2] + granted))
+
+                # ping
+                if packet_type == 12:
+                    writer.write(mqttPacket(0xd0, b''))
+
+                # disconnect
+                if packet_type == 14:
+                    break
+
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscriptions.pop(writer, None)
+            writer.close()
+
+    def route(self, topic, payload):
+        packet = None
+
+        for writer, filters in list(self.subscriptions.items()):
+            if not any(topicMatches(f, topic) for f in filters):
+                continue
+
+            if packet is None:
+                packet = mqttPublishPacket(topic, payload)
+
+            writer.write(packet)
+            self.stats['delivered'] += 1
+
+    def publish(self, topic, payload):
+        if type(payload) != bytes:
+            payload = json.dumps(payload).encode()
+
+        self.loop.call_soon_threadsafe(self.route, topic, payload)
+
+    def subscribers(self):
+        return sum(len(f) for f in list(self.subscriptions.values()))
+
+##
+# HTTP devices
+##
+
+class DeviceHandler(http.server.BaseHTTPRequestHandler):
+    # volumio (/api/v1/...) and mystrom (/report, /relay, /toggle) api
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server.standin
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        server.stats['requests'] += 1
+
+        if server.latency:
+            time.sleep(random.uniform(0, 2 * server.latency))
+
+        if server.failure_rate and random.random() < server.failure_rate:
+            server.stats['failures'] += 1
+            return self.reply(500, { 'error': 'injected failure' })
+
+        if url.path == '/api/v1/getState':
+            return self.reply(200, server.volumio)
+
+        if url.path == '/api/v1/commands/':
+            cmd = query.get('cmd')
+
+            if cmd == 'volume':
+                server.volumio['volume'] = int(query.get('volume', 0))
+
+            if cmd == 'toggle':
+                server.volumio['status'] = 'pause' if server.volumio['status'] == 'play' else 'play'
+
+            if cmd in [ 'pause', 'stop' ]:
+                server.volumio['status'] = cmd
+
+            return self.reply(200, { 'time': int(time.time() * 1000), 'response': '{} Success'.format(cmd) })
+
+        if url.path == '/report':
+            report = dict(server.mystrom, power=round(random.uniform(0, 50), 2) if server.mystrom['relay'] else 0)
+            return self.reply(200, report)
+
+        if url.path == '/relay':
+            server.mystrom['relay'] = query.get('state') == '1'
+            return self.reply(200, {})
+
+        if url.path == '/toggle':
+            server.mystrom['relay'] = not server.mystrom['relay']
+            return self.reply(200, { 'relay': server.mystrom['relay'] })
+
+        self.reply(404, { 'error': 'not found' })
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DeviceServer():
+    # one volumio player and one mystrom switch. requests take latency seconds
+    # on average (uniform 0..2*latency), failure_rate of them are answered with 500.
+    def __init__(self, host='127.0.0.1', port=0, latency=0, failure_rate=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.stats = { 'requests': 0, 'failures': 0 }
+
+        self.volumio = { 'status': 'play', 'volume': 30, 'title': 'Bench', 'artist': 'Stand-in', 'seek': 0 }
+        self.mystrom = { 'relay': True, 'power': 0, 'Ws': 0, 'temperature': 21.5 }
+
+        self.server = http.server.ThreadingHTTPServer((host, port), DeviceHandler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.address = '{}:{}'.format(host, self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='http-devices', daemon=True).start()
+
+        return self
+
+##
+# Graphite
+##
+
+class CarbonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            self.server.standin.stats['metrics'] += 1
+
+class RenderHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server.standin
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        server.stats['requests'] += 1
+
+        if url.path.rstrip('/') == '/metrics/find':
+            prefix = query.get('query', '').rstrip('*')
+            data = [ { 'text': m, 'id': prefix + m, 'leaf': 1 } for m in [ 'temperature', 'humidity', 'battery' ] ]
+            body = json.dumps(data).encode()
+            content_type = 'application/json'
+        else:
+            body = server.png
+            content_type = 'image/png'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class GraphiteServer():
+    # carbon plaintext receiver (counts metric lines) and a render api serving
+    # a fixed png and metrics/find results
+    def __init__(self, host='127.0.0.1', png_size=30 * 1024):
+        self.stats = { 'metrics': 0, 'requests': 0 }
+        self.png = b'\x89PNG\r\n\x1a\n' + os.urandom(png_size)
+
+        self.carbon = socketserver.ThreadingTCPServer((host, 0), CarbonHandler)
+        self.carbon.daemon_threads = True
+        self.carbon.standin = self
+        self.carbon_port = self.carbon.server_address[1]
+
+        self.render = http.server.ThreadingHTTPServer((host, 0), RenderHandler)
+        self.render.daemon_threads = True
+        self.render.standin = self
+        self.render_url = 'http://{}:{}'.format(host, self.render.server_port)
+
+    def start(self):
+        threading.Thread(target=self.carbon.serve_forever, name='carbon', daemon=True).start()
+        threading.Thread(target=self.render.serve_forever, name='graphite-render', daemon=True).start()
+
+        return self
+
+##
+# Sonos
+##
+
+class SonosPlayer():
+    # the part of soco.SoCo used by the Sonos device class, calls take latency seconds
+    def __init__(self, ip_address, player_name, latency=0):
+        self.ip_address = ip_address
+        self.player_name = player_name
+        self.latency = latency
+        self.is_coordinator = True
+        self.group = types.SimpleNamespace(members=[ self ])
+        self.state = 'PLAYING'
+        self.status_light = False
+        self._volume = 20
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def volume(self):
+        self.wait()
+        return self._volume
+
+    @volume.setter
+    def volume(self, volume):
+        self.wait()
+        self._volume = volume
+
+    def get_current_transport_info(self):
+        self.wait()
+        return { 'current_transport_state': self.state, 'current_transport_status': 'OK', 'current_transport_speed': '1' }
+
+    def play(self):
+        self.wait()
+        self.state = 'PLAYING'
+
+    def pause(self):
+        self.wait()
+        self.state = 'PAUSED_PLAYBACK'
+
+    def join(self, master):
+        self.wait()
+        self.is_coordinator = False
+        master.group.members.append(self)
+
+    def unjoin(self):
+        self.wait()
+        self.is_coordinator = True
+
+class SonosSystem():
+    # replaces soco.discover() and soco.SoCo() with in-memory players
+    def __init__(self, names, latency=0):
+        self.players = { '10.0.0.{}'.format(i + 10): SonosPlayer('10.0.0.{}'.format(i + 10), name, latency) for i, name in enumerate(names) }
+
+    def discover(self, timeout=5, **kwargs):
+        return set(self.players.values())
+
+    def install(self):
+        import soco
+
+        soco.discover = self.discover
+        soco.SoCo = lambda ip: self.players[ip]
+
+        return self
+
+##
+# Config
+##
+
+def writeConfig(config, directory=None):
+    # writes config.yml to a new temporary directory (or directory) and points
+    # HOMEAUTO_CONFIG to it. storage_directory defaults to <directory>/store/.
+    if not directory:
+        directory = tempfile.mkdtemp(prefix='homeauto-bench-')
+
+    config = dict(config)
+    config.setdefault('storage_directory', os.path.join(directory, 'store') + '/')
+    os.makedirs(config['storage_directory'], exist_ok=True)
+
+    with open(os.path.join(directory, 'config.yml'), 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+    os.environ['HOMEAUTO_CONFIG'] = directory
+
+    return directory
@@ -0,0 +1,78 @@
+#!/bin/python
+# Measures the import time of utils and the scenes with python -X importtime
+# and fails when a target exceeds the budget or imports a driver eagerly.
+#
+#   python bench/startup.py [--runs 5] [--budget 120]
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+root = os.path.abspath(os.path.join(sys.path[0], '..'))
+
+# driver dependencies which must only be imported on first use
+LAZY_MODULES = [ 'yaml', 'requests', 'paho.mqtt.client', 'soco' ]
+
+TARGETS = [ 'utils' ] + sorted('scenes.' + f[:-3] for f in os.listdir(os.path.join(root, 'scenes')) if f.endswith('.py'))
+
+def importTime(target, config):
+    # returns the cumulative import time of target in ms and all imported modules
+    code = 'import sys; sys.path.insert(0, {!r}); sys.path.insert(0, {!r}); import {}'.format(
+        root,
+        os.path.join(root, 'scenes'),
+        target.split('.')[-1]
+    )
+
+    env = dict(os.environ, HOMEAUTO_CONFIG=config)
+    p = subprocess.run([ sys.executable, '-X', 'importtime', '-c', code ], env=env, capture_output=True, text=True, cwd=root)
+
+    if p.returncode != 0:
+        raise RuntimeError('import of {} failed:\n{}'.format(target, p.stderr))
+
+    modules = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative) / 1000
+
+    return modules[target.split('.')[-1]], modules
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='imports per target, the median is reported')
+    parser.add_argument('--budget', type=float, default=120, help='max import time per target in ms')
+    parser.add_argument('--config', default=os.environ.get('HOMEAUTO_CONFIG', root), help='config directory')
+    args = parser.parse_args()
+
+    # warm up the bytecode cache
+    subprocess.run([ sys.executable, '-m', 'compileall', '-q', root ], cwd=root)
+
+    failed = []
+    for target in TARGETS:
+        times = []
+        for i in range(args.runs):
+            elapsed, modules = importTime(target, args.config)
+            times.append(elapsed)
+
+        median = statistics.median(times)
+        eager = [ m for m in LAZY_MODULES if m in modules ]
+
+        status = 'ok'
+        if median > args.budget:
+            status = 'over budget'
+        if eager:
+            status = 'imports {}'.format(', '.join(eager))
+        if status != 'ok':
+            failed.append(target)
+
+        print('{:<36} {:>8.1f} ms  {}'.format(target, median, status))
+
+    if failed:
+        print('budget of {} ms exceeded or drivers imported eagerly: {}'.format(args.budget, ', '.join(failed)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
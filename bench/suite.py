@@ -0,0 +1,410 @@
+#!/bin/python
+# Micro-benchmarks of the hot paths against local stand-ins (bench/standins.py)
+# for mqtt, the http devices, sonos and graphite.
+#
+#   python bench/suite.py run [--output baseline.json] [--filter api_] [--scale 0.2]
+#   python bench/suite.py compare baseline.json current.json [--threshold 0.15]
+#
+# run --compare baseline.json runs the suite and compares it in one step. compare
+# exits with 1 when the p50 of a benchmark got slower by more than threshold.
+import io
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import contextlib
+import platform
+import statistics
+import types
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import standins
+
+BENCHMARKS = []
+
+def benchmark(name, number=1000):
+    # the decorated function sets up and returns the operation to time, or
+    # (operation, teardown)
+    def decorator(func):
+        BENCHMARKS.append((name, func, number))
+        return func
+
+    return decorator
+
+##
+# Environment
+##
+
+def setup():
+    broker = standins.MqttBroker().start()
+    devices = standins.DeviceServer().start()
+    graphite = standins.GraphiteServer().start()
+    sonos = standins.SonosSystem([ 'Kitchen', 'Bath' ]).install()
+
+    # state events go to a socket nobody reads, like a stopped worker_graphite
+    events = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    events.bind(('127.0.0.1', 0))
+    events_address = '127.0.0.1:{}'.format(events.getsockname()[1])
+
+    standins.writeConfig({
+        'zigbee2mqtt': { 'server': '127.0.0.1', 'port': broker.port, 'topic': 'zigbee2mqtt' },
+        'metrics': {
+            'server': '127.0.0.1',
+            'port': graphite.carbon_port,
+            'prefix': 'homeautomation',
+            'render_api_base_url': graphite.render_url,
+        },
+        'state_events': { 'listeners': { 'metrics': events_address, 'api': events_address } },
+        'sonos': { 'discover_timeout': 1 },
+        'devices': {
+            'office1': { 'type': 'ikea_lamp', 'zigbee_id': '0x0001', 'metrics': True },
+            'temp1': { 'type': 'zigbee_log', 'zigbee_id': '0x0002', 'metrics': True },
+            'button1': { 'type': 'ikea_button', 'zigbee_id': '0x0003', 'scenes': { 'toggle': 'office_light' } },
+            'switch1': { 'type': 'mystrom_switch', 'address': devices.address, 'metrics': True },
+            'volumio1': { 'type': 'volumio', 'address': devices.address },
+            'sonos1': { 'type': 'sonos', 'player_name': 'Kitchen' },
+            'lora1': { 'type': 'lora_log', 'device_id': 'eui-0001' },
+        },
+        'device_groups': { 'office': { 'devices': [ 'office1', 'switch1' ] } },
+    })
+
+    # thousands of "received: ..." lines would measure the terminal
+    logging.disable(logging.INFO)
+
+    return types.SimpleNamespace(broker=broker, devices=devices, graphite=graphite, sonos=sonos, events=events)
+
+##
+# Benchmarks
+##
+
+@benchmark('config_cached', 100000)
+def configCached():
+    from utils import Config
+
+    return Config
+
+@benchmark('config_parse', 200)
+def configParse():
+    from utils import Config, reloadConfig
+
+    def op():
+        reloadConfig()
+        Config()
+
+    return op
+
+@benchmark('load_devices', 200)
+def loadAllDevices():
+    from utils import loadDevices
+
+    return loadDevices
+
+@benchmark('device_load', 2000)
+def deviceLoad():
+    from utils import registry
+
+    return registry.get('temp1').load
+
+@benchmark('device_update_unchanged', 5000)
+def deviceUpdateUnchanged():
+    from utils import registry
+
+    device = registry.get('temp1')
+
+    return lambda: device.updateData({ 'temperature': 21.0, 'humidity': 40 })
+
+@benchmark('device_update_changed', 5000)
+def deviceUpdateChanged():
+    from utils import registry
+
+    device = registry.get('temp1')
+    counter = iter(range(10 ** 9))
+
+    return lambda: device.updateData({ 'temperature': next(counter) / 10, 'humidity': 40 })
+
+@benchmark('device_save_flush', 1000)
+def deviceSave():
+    from utils import registry, state_writer
+
+    device = registry.get('temp1')
+    counter = iter(range(10 ** 9))
+
+    def op():
+        device.humidity = next(counter)
+        device.save()
+        state_writer.flush()
+
+    return op
+
+@benchmark('zigbee_on_message', 5000)
+def zigbeeOnMessage():
+    import worker_zigbee
+
+    counter = iter(range(10 ** 9))
+
+    def op():
+        payload = json.dumps({ 'temperature': next(counter) / 10, 'humidity': 40, 'linkquality': 120 })
+        worker_zigbee.on_message(None, None, types.SimpleNamespace(topic='zigbee2mqtt/0x0002', payload=payload))
+
+    return op
+
+@benchmark('zigbee_on_message_ignored', 20000)
+def zigbeeOnMessageIgnored():
+    import worker_zigbee
+
+    msg = types.SimpleNamespace(topic='zigbee2mqtt/0x0002/availability', payload='{"state": "online"}')
+
+    return lambda: worker_zigbee.on_message(None, None, msg)
+
+@benchmark('scene_dispatch', 1000)
+def sceneDispatch():
+    from utils import registry, sceneRunner, scene_stats
+
+    button = registry.get('button1')
+    runs = scene_stats.get('office_light', {}).get('runs', 0)
+
+    def teardown(number):
+        # every dispatched scene has to finish, the time is reported separately
+        deadline = time.monotonic() + 30
+
+        while scene_stats.get('office_light', {}).get('runs', 0) < runs + number and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    return (lambda: button.receiveMsg({ 'action': 'toggle', 'linkquality': 100 })), teardown
+
+@benchmark('lora_webhook', 2000)
+def loraWebhook():
+    import app
+
+    client = app.app.test_client()
+    payload = { 'end_device_ids': { 'device_id': 'eui-0001' }, 'uplink_message': { 'decoded_payload': { 'TempC_SHT': 21.5, 'Hum_SHT': 40 } } }
+
+    return (lambda: client.post('/api/v1/lora/webhook', json=payload)), lambda number: app.lora_queue.join()
+
+def apiGet(path, headers=None):
+    import app
+
+    client = app.app.test_client()
+
+    return lambda: client.get(path, headers=headers)
+
+@benchmark('api_devices', 2000)
+def apiDevices():
+    return apiGet('/api/v1/devices')
+
+@benchmark('api_devices_expand', 1000)
+def apiDevicesExpand():
+    return apiGet('/api/v1/devices?expand=1')
+
+@benchmark('api_device', 2000)
+def apiDevice():
+    return apiGet('/api/v1/devices/temp1')
+
+@benchmark('api_device_not_modified', 2000)
+def apiDeviceNotModified():
+    import app
+
+    etag = app.app.test_client().get('/api/v1/devices/office1').headers['ETag']
+
+    return apiGet('/api/v1/devices/office1', headers={ 'If-None-Match': etag })
+
+@benchmark('api_device_metrics', 2000)
+def apiDeviceMetrics():
+    return apiGet('/api/v1/devices/temp1/metrics')
+
+@benchmark('api_render_cached', 2000)
+def apiRenderCached():
+    return apiGet('/api/v1/devices/temp1/metrics/temperature')
+
+@benchmark('api_action_zigbee', 2000)
+def apiActionZigbee():
+    import app
+
+    client = app.app.test_client()
+
+    return lambda: client.post('/api/v1/devices/office1', json={ 'action': 'brightness', 'msg': { 'brightness': 100, 'transition': 1 } })
+
+@benchmark('api_action_http', 500)
+def apiActionHttp():
+    import app
+
+    client = app.app.test_client()
+
+    return lambda: client.post('/api/v1/devices/switch1', json={ 'action': 'toggle' })
+
+@benchmark('api_action_sonos', 200)
+def apiActionSonos():
+    import app
+
+    client = app.app.test_client()
+    client.post('/api/v1/devices/sonos1', json={ 'action': 'getState' })
+
+    return lambda: client.post('/api/v1/devices/sonos1', json={ 'action': 'volume', 'msg': 25 })
+
+@benchmark('api_actions_batch', 500)
+def apiActionsBatch():
+    import app
+
+    client = app.app.test_client()
+
+    return lambda: client.post('/api/v1/actions', json={ 'device_group': 'office', 'action': 'toggle' })
+
+@benchmark('volumio_get_state', 1000)
+def volumioGetState():
+    from utils import registry
+
+    return registry.get('volumio1').getState
+
+##
+# Runner
+##
+
+def measure(func, number):
+    with contextlib.redirect_stdout(io.StringIO()):
+        setup_result = func()
+    teardown = None
+
+    if type(setup_result) == tuple:
+        op, teardown = setup_result
+    else:
+        op = setup_result
+
+    # warm up caches, connections and lazy imports
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(max(1, number // 10)):
+            op()
+
+    if teardown:
+        teardown(max(1, number // 10))
+
+    timings = []
+    start = time.perf_counter()
+
+    # app.py prints the payload of every device action
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(number):
+            t = time.perf_counter_ns()
+            op()
+            timings.append(time.perf_counter_ns() - t)
+
+    if teardown:
+        teardown(number)
+
+    elapsed = time.perf_counter() - start
+    timings.sort()
+
+    return {
+        'number': number,
+        'ops': round(number / elapsed, 1),
+        'mean_us': round(statistics.mean(timings) / 1000, 2),
+        'p50_us': round(timings[len(timings) // 2] / 1000, 2),
+        'p99_us': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] / 1000, 2),
+    }
+
+def run(args):
+    env = setup()
+    results = {}
+
+    for name, func, number in BENCHMARKS:
+        if args.filter and args.filter not in name:
+            continue
+
+        number = max(1, int(number * args.scale))
+        results[name] = measure(func, number)
+
+        r = results[name]
+        print('{:<28} {:>10.1f} ops/s  p50 {:>9.1f} us  p99 {:>9.1f} us'.format(name, r['ops'], r['p50_us'], r['p99_us']), flush=True)
+
+    from utils import scene_stats
+
+    if scene_stats.get('office_light', {}).get('runs'):
+        stats = scene_stats['office_light']
+        print('scene office_light: {} runs, avg {:.1f} ms'.format(stats['runs'], stats['total'] / stats['runs'] * 1000))
+
+    print('stand-ins: mqtt {}, http devices {}, graphite {}'.format(env.broker.stats, env.devices.stats, env.graphite.stats))
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        print('saved to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            return compareReports(json.load(f), report, args.threshold)
+
+    return 0
+
+def compareReports(baseline, current, threshold):
+    regressions = []
+
+    print('{:<28} {:>12} {:>12} {:>8}'.format('benchmark', 'p50 before', 'p50 now', 'change'))
+
+    for name, r in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+
+        if not before:
+            print('{:<28} {:>12} {:>9.1f} us {:>8}'.format(name, '-', r['p50_us'], 'new'))
+            continue
+
+        change = (r['p50_us'] - before['p50_us']) / before['p50_us'] if before['p50_us'] else 0
+        flag = ''
+
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+
+        print('{:<28} {:>9.1f} us {:>9.1f} us {:>+7.1%}{}'.format(name, before['p50_us'], r['p50_us'], change, flag))
+
+    if regressions:
+        print('{} slower than {:.0%} threshold: {}'.format(len(regressions), threshold, ', '.join(regressions)))
+        return 1
+
+    return 0
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    with open(args.current) as f:
+        current = json.load(f)
+
+    return compareReports(baseline, current, args.threshold)
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--output', help='save the results as json baseline')
+    run_parser.add_argument('--filter', help='only run benchmarks containing this string')
+    run_parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of iterations')
+    run_parser.add_argument('--compare', help='baseline to compare the results with')
+    run_parser.add_argument('--threshold', type=float, default=0.15, help='allowed p50 slowdown, 0.15 = 15%%')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two saved results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.15, help='allowed p50 slowdown, 0.15 = 15%%')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    status = args.func(args)
+
+    # the lora consumer, scene runner and sonos threads never return
+    sys.stdout.flush()
+    os._exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -30,36 +30,65 @@ def env_default(envvar):
         return EnvDefault(envvar, **kwargs)
     return wrapper
 
+# define key for table here per device type:
+keys_overview_per_device = {
+    'ikea_lamp':     [ 'battery', 'name', 'state', 'last_update.human' ],
+    'ikea_switch':   [ 'battery', 'name', 'state', 'last_update.human' ],
+    'ikea_button':   [ 'battery', 'name', 'state', 'last_update.human' ],
+    'zigbee_log':     [ 'battery', 'name', 'humidity', 'pressure', 'temperature', 'last_update.human' ],
+    'mystrom_switch':[ 'name', 'relay', 'power', 'last_update.human' ],
+    'sonos':[ 'name', 'play_state', 'volume', 'last_update.human' ],
+}
+
 ##
 # list devices
 ##
 def list_devices(base_url, print_json=False, internal=False, device_list=None):
-    if not device_list:
-        url = base_url.rstrip('/') + '/api/v1/devices'
-        r = requests.get(url)
+    url = base_url.rstrip('/') + '/api/v1/devices'
 
-        if r.status_code == 200:
-            data = r.json()
+    if internal or print_json:
+        if not device_list:
+            r = requests.get(url)
 
-    if device_list:
-        data = device_list.split(',')
+            if r.status_code == 200:
+                data = r.json()
+
+        if device_list:
+            data = device_list.split(',')
 
-    if internal:
-        return data
+        if internal:
+            return data
 
-    if print_json:
         print(json.dumps(data, indent=2))
+        return
+
+    # all device details with one request
+    fields = { 'type' }
+    for keys in keys_overview_per_device.values():
+        fields.update(keys)
 
-    if not print_json:
-        # get device details
-        new_data = []
-        for device in data:
-            d = get_device_details(base_url, device, print_json=print_json, internal=True)
+    r = requests.get(url, params={ 'expand': 1, 'fields': ','.join(sorted(fields)) })
 
-            if d:
-                new_data.append(d)
+    if r.status_code != 200:
+        print('ERROR - {} returned {}'.format(url, r.status_code))
+        return
 
-        print(tabulate(new_data, headers="keys"))
+    devices = r.json()
+
+    if device_list:
+        names = device_list.split(',')
+    else:
+        names = devices.keys()
+
+    new_data = []
+    for name in names:
+        d = devices.get(name)
+
+        if d:
+            allowed_keys = keys_overview_per_device.get(d.get('type'), [])
+            new_data.append(filter_keys(d, allowed_keys))
+
+    print(tabulate(new_data, headers="keys"))
 
 ##
 # filter keys for allowed_keys list
@@ -84,16 +113,6 @@ def filter_keys(data, allowed_keys, prefix=False):
 # get device
 ##
 def get_device_details(base_url, device, print_json=None, internal=False):
-    # define key for table here per device type:
-    keys_overview_per_device = {
-        'ikea_lamp':     [ 'battery', 'name', 'state', 'last_update.human' ],
-        'ikea_switch':   [ 'battery', 'name', 'state', 'last_update.human' ],
-        'ikea_button':   [ 'battery', 'name', 'state', 'last_update.human' ],
-        'zigbee_log':     [ 'battery', 'name', 'humidity', 'pressure', 'temperature', 'last_update.human' ],
-        'mystrom_switch':[ 'name', 'relay', 'power', 'last_update.human' ],
-        'sonos':[ 'name', 'play_state', 'volume', 'last_update.human' ],
-    }
-
     url = base_url.rstrip('/') + '/api/v1/devices/' + device
 
     r = requests.get(url)
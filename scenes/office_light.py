@@ -6,6 +6,9 @@ import time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-office1 = loadDevice('office1')
-office1.setState('toggle')
+def run():
+    office1 = registry.get('office1')
+    office1.setState('toggle')
 
+if __name__ == "__main__":
+    run(*sys.argv[1:])
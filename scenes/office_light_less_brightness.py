@@ -6,13 +6,17 @@ import time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-office1 = loadDevice('office1')
+def run():
+    office1 = registry.get('office1')
 
-b = office1.brightness - 10
-if b == 0:
-    b = 1
+    b = office1.brightness - 10
+    if b == 0:
+        b = 1
 
-r,_ = office1.setBrightness(b)
+    r,_ = office1.setBrightness(b)
 
-if not r or b == 1:
-    office1.action("effect",{"effect": "blink"})
+    if not r or b == 1:
+        office1.action("effect",{"effect": "blink"})
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
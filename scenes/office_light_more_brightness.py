@@ -6,8 +6,12 @@ import time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-office1 = loadDevice('office1')
-r,_ = office1.setBrightness(office1.brightness + 10)
+def run():
+    office1 = registry.get('office1')
+    r,_ = office1.setBrightness(office1.brightness + 10)
 
-if not r:
-    office1.action("effect",{"effect": "blink"})
+    if not r:
+        office1.action("effect",{"effect": "blink"})
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
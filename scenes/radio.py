@@ -6,22 +6,33 @@ import time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-switch = loadDevice('music_switch')
-volumio = loadDevice('volumio')
+# seconds to wait for volumio after powering it on
+MAX_WAIT = 120
 
+def run():
+    switch = registry.get('music_switch')
+    volumio = registry.get('volumio')
 
-# if already online and playing, we stop volumio playback
-if switch.relay:
-    if volumio.status == 'play':
-        volumio.sendCmd('stop')
-        sys.exit(0)
+    # if already online and playing, we stop volumio playback
+    if switch.relay:
+        if volumio.status == 'play':
+            volumio.sendCmd('stop')
+            return
 
-switch.setState('on')
+    switch.setState('on')
 
-while not volumio.online:
-    volumio.getState()
-    log.info("Waiting for Volumio to come online")
-    time.sleep(2)
+    deadline = time.monotonic() + MAX_WAIT
+    while not volumio.online:
+        if time.monotonic() > deadline:
+            log.error("Volumio did not come online within {}s".format(MAX_WAIT))
+            return
 
-volumio.setVolume(40)
-volumio.sendCmd('toggle')
+        volumio.getState()
+        log.info("Waiting for Volumio to come online")
+        time.sleep(2)
+
+    volumio.setVolume(40)
+    volumio.sendCmd('toggle')
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
@@ -6,6 +6,9 @@ import time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-switch = loadDevice('music_switch')
-switch.setState('off')
+def run():
+    switch = registry.get('music_switch')
+    switch.setState('off')
 
+if __name__ == "__main__":
+    run(*sys.argv[1:])
@@ -2,11 +2,13 @@
 import os
 import sys
 import time
-from soco import SoCo
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-device_name = sys.argv[1]
-sonos = loadDevice(device_name)
-sonos.doToggle()
+def run(device_name):
+    sonos = registry.get(device_name)
+    sonos.doToggle()
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
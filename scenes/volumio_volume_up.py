@@ -6,10 +6,14 @@ import time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from utils import *
 
-volumio = loadDevice('volumio')
+def run():
+    volumio = registry.get('volumio')
 
-if not volumio.online:
-    log.info("Volumio is not online, exiting...")
-    sys.exit(0)
+    if not volumio.online:
+        log.info("Volumio is not online, exiting...")
+        return
 
-volumio.setVolume(volumio.volume + 5)
+    volumio.setVolume(volumio.volume + 5)
+
+if __name__ == "__main__":
+    run(*sys.argv[1:])
@@ -2,34 +2,102 @@ import os
 import sys
 import time
 import json
-import yaml
+import atexit
+import bisect
+import hashlib
+import collections
 import logging
-import requests
+import queue
+import signal
+import socket
+import sqlite3
+import threading
 import subprocess
-import paho.mqtt.client as mqtt
-import soco
+import importlib
+import importlib.util
+import concurrent.futures
+
+class LazyModule():
+    # imported on first attribute access, scenes and workers only pay for the
+    # drivers of the devices they actually use
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self._name)
+
+yaml = LazyModule('yaml')
+requests = LazyModule('requests')
+mqtt = LazyModule('paho.mqtt.client')
+soco = LazyModule('soco')
+http_server = LazyModule('http.server')
 
 ##
 # Config
 ##
 
-def Config():
-    dir_path = os.path.dirname(os.path.realpath(__file__))
+# seconds between mtime/size checks of the config files, Config() returns
+# the cached snapshot in between without touching the filesystem
+CONFIG_CHECK_INTERVAL = 1
 
-    main_config_path = dir_path + '/config.yml'
-    additional_config_path = dir_path + '/conf.d/'
+config_stats = {
+    'parses': 0,
+    'checks': 0,
+    'hits': 0,
+}
 
-    # load main config
-    config = {}
-    if os.path.isfile(main_config_path):
-        with open(main_config_path, 'r') as f:
-            config = yaml.safe_load(f)
+_config_lock = threading.Lock()
+_config_cache = {
+    'snapshot': None,
+    'signature': None,
+    'checked': 0,
+}
 
-    # load additional config files
-    if os.path.exists(additional_config_path):
-        additional_config = os.listdir(additional_config_path)
+class FrozenDict(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('config is read-only, use copy.deepcopy() for a mutable copy')
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __reduce__(self):
+        # copies (copy.copy/deepcopy, pickle) are plain, mutable dicts
+        return (dict, (dict(self),))
+
+    def __hash__(self):
+        return id(self)
 
-        for file in additional_config:
+def freeze(data):
+    if isinstance(data, dict):
+        return FrozenDict((k, freeze(v)) for k, v in data.items())
+
+    if isinstance(data, list):
+        return tuple(freeze(v) for v in data)
+
+    return data
+
+def configPaths():
+    dir_path = os.environ.get('HOMEAUTO_CONFIG', os.path.dirname(os.path.realpath(__file__)))
+
+    main_config_path = dir_path.rstrip('/') + '/config.yml'
+    additional_config_path = dir_path.rstrip('/') + '/conf.d/'
+
+    paths = [ main_config_path ]
+
+    if os.path.exists(additional_config_path):
+        for file in sorted(os.listdir(additional_config_path)):
             file_extension = file.split('.')[-1]
 
             if file == 'config.yml':
@@ -38,13 +106,45 @@ def Config():
             if not (file_extension == 'yml' or file_extension == 'yaml'):
                 continue
 
-            with open(additional_config_path + file, 'r') as f:
-                c = yaml.safe_load(f)
+            paths.append(additional_config_path + file)
+
+    return paths
+
+def configSignature(paths):
+    signature = []
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            signature.append((path, None, None))
+            continue
+
+        signature.append((path, st.st_mtime_ns, st.st_size))
+
+    return tuple(signature)
+
+def parseConfig(paths):
+    main_config_path = paths[0]
+
+    # load main config
+    config = {}
+    if os.path.isfile(main_config_path):
+        with open(main_config_path, 'r') as f:
+            config = yaml.safe_load(f) or {}
 
-            #for token in c['api_tokens']:
-            #    config['api_tokens'].append(token)
+    # load additional config files
+    for path in paths[1:]:
+        with open(path, 'r') as f:
+            c = yaml.safe_load(f)
+
+        if not c:
+            continue
 
-            config.update(c)
+        #for token in c['api_tokens']:
+        #    config['api_tokens'].append(token)
+
+        config.update(c)
 
     ## generate api_tokens_list
     #config['api_tokens_list'] = []
@@ -52,7 +152,56 @@ def Config():
     #for key in config['api_tokens'].keys():
     #    config['api_tokens_list'].append(config['api_tokens'][key]['token'])
 
-    return config
+    config_stats['parses'] += 1
+
+    return freeze(config)
+
+def Config():
+    # returns a process wide, read-only snapshot of config.yml and conf.d/*.yml
+    # the files are only parsed again when their mtime/size changes or after reloadConfig()
+    now = time.monotonic()
+    snapshot = _config_cache['snapshot']
+
+    if snapshot is not None and now - _config_cache['checked'] < CONFIG_CHECK_INTERVAL:
+        config_stats['hits'] += 1
+        return snapshot
+
+    with _config_lock:
+        paths = configPaths()
+        signature = configSignature(paths)
+        config_stats['checks'] += 1
+
+        # set by requestConfigReload(), pop() clears it in one step
+        reload = _config_cache.pop('reload', False)
+
+        if _config_cache['snapshot'] is None or reload or signature != _config_cache['signature']:
+            _config_cache['snapshot'] = parseConfig(paths)
+            _config_cache['signature'] = signature
+
+        _config_cache['checked'] = time.monotonic()
+
+        return _config_cache['snapshot']
+
+def requestConfigReload(*args):
+    # signal handler, must not take _config_lock: the signal can arrive while the
+    # main thread holds it in Config(). the next Config() call parses the files.
+    _config_cache['reload'] = True
+    _config_cache['checked'] = 0
+
+def reloadConfig():
+    requestConfigReload()
+
+    return Config()
+
+def exitHandler(*args):
+    # raising SystemExit runs the atexit hooks, e.g. flushing pending device state
+    sys.exit(0)
+
+def installSignalHandlers():
+    # SIGHUP: re-read the configuration
+    # SIGTERM: exit cleanly
+    signal.signal(signal.SIGHUP, requestConfigReload)
+    signal.signal(signal.SIGTERM, exitHandler)
 
 ##
 # logger
@@ -82,7 +231,1336 @@ def logger(name=''):
 
     return logger
 
-log = logger()
+class LazyLogger():
+    # logger() reads the config, which is deferred until the first log call
+    def __init__(self, name=''):
+        self.name = name
+        self.logger = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self.logger is None:
+            with self.lock:
+                if self.logger is None:
+                    self.logger = logger(self.name)
+
+        return getattr(self.logger, attr)
+
+log = LazyLogger()
+
+##
+# Process instances
+##
+
+# stores, connection pools, thread pools and caches must not be shared with
+# forked processes, every process creates its own on first use
+_process_instances = {}
+_process_instance_locks = {}
+
+def processInstance(name, settings, factory, replaced=None):
+    # returns the instance <name> of this process, factory() creates it. an
+    # instance created with other settings is replaced, replaced(old, new) can
+    # stop the old one or hand its state over
+    key = (name, os.getpid())
+
+    entry = _process_instances.get(key)
+    if entry and entry[0] == settings:
+        return entry[1]
+
+    with _process_instance_locks.setdefault(name, threading.Lock()):
+        entry = _process_instances.get(key)
+
+        if not entry or entry[0] != settings:
+            instance = factory()
+
+            if entry and replaced:
+                replaced(entry[1], instance)
+
+            entry = _process_instances[key] = (settings, instance)
+
+    return entry[1]
+
+def processInstances(prefix):
+    # instances of this process whose name starts with prefix
+    pid = os.getpid()
+
+    return { name: entry[1] for (name, p), entry in list(_process_instances.items()) if p == pid and name.startswith(prefix) }
+
+##
+# Instrumentation
+##
+
+# prometheus histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+INSTRUMENTATION_METRICS = {
+    'homeauto_http_requests_total': ('counter', 'Flask requests by route, method and status'),
+    'homeauto_http_request_duration_seconds': ('histogram', 'Flask request duration by route'),
+    'homeauto_device_action_duration_seconds': ('histogram', 'Device action() duration by device and action'),
+    'homeauto_mqtt_publish_duration_seconds': ('histogram', 'Time until the broker acknowledged a publish'),
+    'homeauto_mqtt_publish_failures_total': ('counter', 'Publishes paho refused to queue'),
+    'homeauto_graphite_render_duration_seconds': ('histogram', 'Time until graphite answered a render request'),
+    'homeauto_http_poll_duration_seconds': ('histogram', 'worker_http getState() duration by device and result'),
+    'homeauto_zigbee_messages_total': ('counter', 'worker_zigbee messages by result'),
+    'homeauto_scene_duration_seconds': ('histogram', 'Scene execution time by scene and result'),
+    'homeauto_state_write_duration_seconds': ('histogram', 'Device state store writes'),
+    'homeauto_state_updates_total': ('counter', 'Device updateData() calls'),
+    'homeauto_state_writes_total': ('counter', 'State store writes'),
+    'homeauto_state_writes_avoided_total': ('counter', 'Updates without changes which were not written'),
+    'homeauto_state_fields_written_total': ('counter', 'Fields written to the state store'),
+    'homeauto_config_parses_total': ('counter', 'Config file parses'),
+    'homeauto_lora_queue_depth': ('gauge', 'LoRa uplinks waiting to be processed'),
+    'homeauto_lora_uplinks_total': ('counter', 'LoRa uplinks by result'),
+    'homeauto_state_events_published_total': ('counter', 'State events sent to the listeners'),
+    'homeauto_state_events_dropped_total': ('counter', 'State events which could not be sent'),
+    'homeauto_state_event_subscriber_drops_total': ('counter', 'State events dropped because a subscriber queue was full, by listener'),
+}
+
+class Instrumentation():
+    # prometheus style counters and histograms. every thread writes to its own
+    # dicts without locking, render() merges them. shards of finished threads
+    # are folded into one so short lived request threads do not pile up.
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = { 'counters': {}, 'histograms': {} }
+        self.collectors = []
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+
+        if shard is None:
+            shard = { 'counters': {}, 'histograms': {} }
+
+            with self.lock:
+                self.retire()
+                self.shards.append((threading.current_thread(), shard))
+
+            self.local.shard = shard
+
+        return shard
+
+    def retire(self):
+        # called with self.lock held
+        alive = []
+
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+
+        self.shards = alive
+
+    def merge(self, target, shard):
+        for key, value in list(shard['counters'].items()):
+            target['counters'][key] = target['counters'].get(key, 0) + value
+
+        for key, buckets in list(shard['histograms'].items()):
+            merged = target['histograms'].setdefault(key, [ 0 ] * len(buckets))
+
+            for i, value in enumerate(list(buckets)):
+                merged[i] += value
+
+    def inc(self, name, value=1, **labels):
+        counters = self.shard()['counters']
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        histograms = self.shard()['histograms']
+        key = (name, tuple(sorted(labels.items())))
+        buckets = histograms.get(key)
+
+        # one slot per bucket, +Inf and the sum
+        if buckets is None:
+            buckets = histograms[key] = [ 0 ] * (len(LATENCY_BUCKETS) + 2)
+
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        buckets[-1] += seconds
+
+    def collector(self, func):
+        # func() returns (name, labels, value) samples which are read at scrape time
+        self.collectors.append(func)
+
+        return func
+
+    def snapshot(self):
+        merged = { 'counters': {}, 'histograms': {} }
+
+        with self.lock:
+            self.retire()
+            self.merge(merged, self.retired)
+
+            for thread, shard in self.shards:
+                self.merge(merged, shard)
+
+        return merged
+
+    def render(self, extra_labels=None):
+        # prometheus text exposition format 0.0.4
+        merged = self.snapshot()
+        extra = tuple(sorted((extra_labels or {}).items()))
+        samples = {}
+
+        def labelString(labels):
+            if not labels:
+                return ''
+
+            escaped = [ '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels ]
+            return '{' + ','.join(escaped) + '}'
+
+        for (name, labels), value in sorted(merged['counters'].items(), key=lambda item: str(item[0])):
+            samples.setdefault(name, []).append('{}{} {}'.format(name, labelString(extra + labels), value))
+
+        for func in self.collectors:
+            try:
+                for name, labels, value in func():
+                    samples.setdefault(name, []).append('{}{} {}'.format(name, labelString(extra + tuple(sorted(labels.items()))), value))
+            except Exception as e:
+                log.error('metrics collector {} failed: {}'.format(func.__name__, e))
+
+        for (name, labels), buckets in sorted(merged['histograms'].items(), key=lambda item: str(item[0])):
+            lines = samples.setdefault(name, [])
+            count = 0
+
+            for le, value in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                count += value
+                lines.append('{}_bucket{} {}'.format(name, labelString(extra + labels + (('le', le),)), count))
+
+            lines.append('{}_sum{} {}'.format(name, labelString(extra + labels), buckets[-1]))
+            lines.append('{}_count{} {}'.format(name, labelString(extra + labels), count))
+
+        out = []
+        for name in sorted(samples):
+            metric_type, description = INSTRUMENTATION_METRICS.get(name, ('untyped', name))
+
+            out.append('# HELP {} {}'.format(name, description))
+            out.append('# TYPE {} {}'.format(name, metric_type))
+            out += samples[name]
+
+        return '\n'.join(out) + '\n'
+
+instrumentation = Instrumentation()
+
+@instrumentation.collector
+def stateStoreSamples():
+    return [
+        ('homeauto_state_updates_total', {}, state_stats['updates']),
+        ('homeauto_state_writes_total', {}, state_stats['writes_performed']),
+        ('homeauto_state_writes_avoided_total', {}, state_stats['writes_avoided']),
+        ('homeauto_state_fields_written_total', {}, state_stats['fields_written']),
+        ('homeauto_config_parses_total', {}, config_stats['parses']),
+    ]
+
+def writeMetricsTextfile(process, directory, interval):
+    path = '{}/homeauto_{}.prom'.format(directory.rstrip('/'), process)
+
+    while True:
+        time.sleep(interval)
+
+        try:
+            # the textfile collector must never see a half written file
+            with open(path + '.tmp', 'w') as f:
+                f.write(instrumentation.render({ 'process': process }))
+
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            log.error('writing {} failed: {}'.format(path, e))
+
+def exposeMetrics(process):
+    # for workers without a web server:
+    #
+    # instrumentation:
+    #   textfile_directory: writes homeauto_<process>.prom for the node_exporter textfile collector
+    #   textfile_interval: 15
+    #   ports:
+    #     worker_zigbee: 9101   serves http://127.0.0.1:9101/metrics
+    config = Config().get('instrumentation', {})
+
+    if config.get('textfile_directory'):
+        threading.Thread(
+            target=writeMetricsTextfile,
+            args=(process, config['textfile_directory'], config.get('textfile_interval', 15)),
+            name='metrics-textfile',
+            daemon=True
+        ).start()
+
+    port = config.get('ports', {}).get(process)
+
+    if port:
+        # defined here, http.server is only imported when it is used
+        class MetricsHandler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = instrumentation.render({ 'process': process }).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            server = http_server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        except OSError as e:
+            log.error('metrics endpoint on port {} failed: {}'.format(port, e))
+            return
+
+        server.daemon_threads = True
+
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+
+##
+# State store
+##
+
+class JsonStateStore():
+    # one <storage_directory>/<device>.json file per device, always rewritten as a whole
+    def __init__(self, directory):
+        self.directory = directory.rstrip('/')
+
+    def filename(self, name):
+        return self.directory + '/' + name + '.json'
+
+    def load(self, name):
+        filename = self.filename(name)
+
+        if not os.path.isfile(filename):
+            return {}
+
+        with open(filename) as f:
+            return json.load(f)
+
+    def save(self, name, data, keys=None):
+        filename = self.filename(name)
+        tmp_filename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+
+        # readers never see a half written file
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_filename, filename)
+
+        return self.version(name)
+
+    def version(self, name):
+        try:
+            return os.stat(self.filename(name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+class SqliteStateStore():
+    # one row per device field in a sqlite database in WAL mode. writers only
+    # upsert the fields they pass, readers get a consistent view of a device
+    # while other processes write to it.
+    def __init__(self, path, json_directory=None):
+        self.path = path
+        self.json_directory = json_directory
+        self.local = threading.local()
+
+        self.migrate()
+
+    def connection(self):
+        # sqlite connections must not be shared between threads or forked processes
+        conn = getattr(self.local, 'conn', None)
+
+        if conn and self.local.pid == os.getpid():
+            return conn
+
+        # the journal mode and the schema are stored in the database, migrate()
+        # sets them up once per process, synchronous is per connection
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+
+        return conn
+
+    def migrate(self):
+        # creates the schema and imports the <device>.json files of the json
+        # store once, they are left in place
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS state (device TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (device, key))')
+        conn.execute('CREATE TABLE IF NOT EXISTS versions (device TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+        if not self.json_directory or not os.path.isdir(self.json_directory):
+            return 0
+
+        json_store = JsonStateStore(self.json_directory)
+        migrated = 0
+
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            if conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+                conn.execute('ROLLBACK')
+                return 0
+
+            for file in sorted(os.listdir(self.json_directory)):
+                if not file.endswith('.json'):
+                    continue
+
+                name = file[:-len('.json')]
+
+                try:
+                    data = json_store.load(name)
+                except ValueError:
+                    log.error('skipping {}, not valid json'.format(file))
+                    continue
+
+                self._upsert(conn, name, data, data.keys())
+                migrated += 1
+
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(time.time()),))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+        if migrated:
+            log.info('migrated {} devices from {} to {}'.format(migrated, self.json_directory, self.path))
+
+        return migrated
+
+    def _upsert(self, conn, name, data, keys):
+        conn.executemany(
+            'INSERT INTO state (device, key, value) VALUES (?, ?, ?) ON CONFLICT (device, key) DO UPDATE SET value = excluded.value',
+            [ (name, k, json.dumps(data[k])) for k in keys ]
+        )
+        conn.execute(
+            'INSERT INTO versions (device, version) VALUES (?, 1) ON CONFLICT (device) DO UPDATE SET version = version + 1',
+            (name,)
+        )
+
+    def load(self, name):
+        rows = self.connection().execute('SELECT key, value FROM state WHERE device = ?', (name,))
+
+        return { k: json.loads(v) for k, v in rows }
+
+    def save(self, name, data, keys=None):
+        if keys is None:
+            keys = data.keys()
+
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+
+        try:
+            self._upsert(conn, name, data, keys)
+            version = conn.execute('SELECT version FROM versions WHERE device = ?', (name,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+        # the version of this write, so the writer does not reload its own state
+        return version
+
+    def version(self, name):
+        row = self.connection().execute('SELECT version FROM versions WHERE device = ?', (name,)).fetchone()
+
+        if not row:
+            return None
+
+        return row[0]
+
+def stateStore():
+    # state_store:
+    #   backend: sqlite (default) or json
+    #   path: <storage_directory>/state.db
+    config = Config()
+    store_config = config.get('state_store', {})
+    storage_directory = config['storage_directory'].rstrip('/')
+
+    backend = store_config.get('backend', 'sqlite')
+    path = store_config.get('path', storage_directory + '/state.db')
+
+    def create():
+        if backend == 'json':
+            return JsonStateStore(storage_directory)
+
+        if backend == 'sqlite':
+            return SqliteStateStore(path, json_directory=storage_directory)
+
+        raise ValueError('unknown state_store backend: {}'.format(backend))
+
+    return processInstance('state_store', (backend, path, storage_directory), create)
+
+def stateVersion(name):
+    # changes whenever the stored state of the device was written
+    return stateStore().version(name)
+
+state_stats = {
+    'updates': 0,
+    'writes_performed': 0,
+    'writes_avoided': 0,
+    'fields_written': 0,
+}
+
+_missing = object()
+
+# distinguishes etags of different processes and restarts
+PROCESS_TOKEN = '{:x}{:x}'.format(os.getpid(), int(time.time() * 1000))
+
+# seconds until a failed state write is tried again
+STATE_WRITE_RETRY = 5
+
+class StateWriter():
+    # write-behind buffer for device state. a device scheduled several times
+    # before its deadline is written once, with all fields changed so far.
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.deadlines = {}
+        self.thread = None
+        self.pid = None
+
+    def schedule(self, device):
+        # state_store:
+        #   flush_delay: max seconds a change waits in memory, 0 writes immediately
+        delay = Config().get('state_store', {}).get('flush_delay', 0.5)
+
+        if delay <= 0:
+            self.write(device)
+            return
+
+        self.enqueue(device, delay)
+
+    def enqueue(self, device, delay):
+        with self.cond:
+            key = id(device)
+
+            if key not in self.pending:
+                self.pending[key] = device
+                self.deadlines[key] = time.monotonic() + delay
+
+            if not self.thread or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='state-writer', daemon=True)
+                self.thread.start()
+
+            self.cond.notify()
+
+    def isPending(self, device):
+        with self.cond:
+            return id(device) in self.pending
+
+    def write(self, device):
+        start = time.perf_counter()
+
+        try:
+            device.flush()
+        except Exception as e:
+            # the device already left pending, try again later instead of losing the changes
+            log.error('{} - writing state failed, retrying in {}s: {}'.format(device.name, STATE_WRITE_RETRY, e))
+            self.enqueue(device, STATE_WRITE_RETRY)
+
+        instrumentation.observe('homeauto_state_write_duration_seconds', time.perf_counter() - start)
+
+    def due(self):
+        now = time.monotonic()
+        due = []
+
+        with self.cond:
+            for key, deadline in list(self.deadlines.items()):
+                if deadline <= now:
+                    due.append(self.pending.pop(key))
+                    del self.deadlines[key]
+
+        return due
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.deadlines:
+                    self.cond.wait()
+
+                timeout = min(self.deadlines.values()) - time.monotonic()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+
+            for device in self.due():
+                self.write(device)
+
+    def flush(self):
+        with self.cond:
+            devices = list(self.pending.values())
+            self.pending = {}
+            self.deadlines = {}
+
+        for device in devices:
+            self.write(device)
+
+state_writer = StateWriter()
+atexit.register(state_writer.flush)
+
+##
+# HTTP
+##
+
+class HttpPool():
+    # one shared requests session per process. urllib3 keeps a pool of
+    # keep-alive connections per host behind it.
+    def __init__(self, pool_connections=10, pool_maxsize=10, timeout=3):
+        self.timeout = timeout
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        stats = {}
+
+        for key in pools.keys():
+            pool = pools.get(key)
+
+            if not pool:
+                continue
+
+            host = '{}://{}:{}'.format(key.key_scheme, key.key_host, key.key_port)
+            stats[host] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+                'reuse_rate': round(1 - pool.num_connections / pool.num_requests, 3) if pool.num_requests else 0,
+            }
+
+        return stats
+
+def httpPool():
+    # http:
+    #   pool_connections: number of hosts with a connection pool
+    #   pool_maxsize: keep-alive connections per host
+    #   timeout: default request timeout in seconds
+    config = Config().get('http', {})
+    settings = (config.get('pool_connections', 10), config.get('pool_maxsize', 10), config.get('timeout', 3))
+
+    return processInstance('http_pool', settings, lambda: HttpPool(*settings))
+
+##
+# Sonos
+##
+
+class SonosTopology():
+    # cached soco.discover() result: player name -> ip, coordinators and groups.
+    # a background thread refreshes it every ttl seconds, SoCo objects are reused.
+    def __init__(self, ttl=60, discover_timeout=5, action_timeout=2):
+        self.ttl = ttl
+        self.action_timeout = action_timeout
+        self.discover_timeout = discover_timeout
+        self.lock = threading.Lock()
+        self.refreshed = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+        self.players = {}
+        self.coordinators = set()
+        self.groups = {}
+        self.updated = 0
+        self.instances = {}
+
+        # player calls of actions fan out over the executor, status light blinks
+        # run on their own so they never delay an action
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='sonos')
+        self.background = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='sonos-blink')
+
+    def soco(self, ip):
+        with self.lock:
+            if ip not in self.instances:
+                self.instances[ip] = soco.SoCo(ip)
+
+            return self.instances[ip]
+
+    def refresh(self):
+        try:
+            zones = soco.discover(timeout=self.discover_timeout)
+        except Exception as e:
+            log.error('sonos discovery failed: {}'.format(e))
+            zones = None
+
+        if not zones:
+            # keep the last known topology
+            self.refreshed.set()
+            return False
+
+        players = {}
+        coordinators = set()
+        groups = {}
+
+        for z in zones:
+            players[z.player_name] = z.ip_address
+
+            if z.is_coordinator:
+                coordinators.add(z.ip_address)
+                groups[z.ip_address] = sorted(m.ip_address for m in z.group.members)
+
+        with self.lock:
+            for z in zones:
+                self.instances[z.ip_address] = z
+
+            self.players = players
+            self.coordinators = coordinators
+            self.groups = groups
+            self.updated = time.monotonic()
+
+        self.refreshed.set()
+
+        return True
+
+    def run(self):
+        while not self.stopped:
+            self.refresh()
+
+            self.wakeup.wait(self.ttl)
+            self.wakeup.clear()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+
+        self.thread = threading.Thread(target=self.run, name='sonos-topology', daemon=True)
+        self.thread.start()
+
+    def invalidate(self):
+        # after join/unjoin the groups changed, refresh in the background
+        self.wakeup.set()
+
+    def takeOver(self, other):
+        # continue with the players of a replaced topology instead of waiting for discovery
+        with other.lock:
+            self.players = other.players
+            self.coordinators = other.coordinators
+            self.groups = other.groups
+            self.instances = dict(other.instances)
+            self.updated = other.updated
+
+        other.shutdown()
+
+    def shutdown(self):
+        # running player calls are finished, the discovery thread ends after its current run
+        self.stopped = True
+        self.wakeup.set()
+        self.executor.shutdown(wait=False)
+        self.background.shutdown(wait=False)
+
+    def fanOut(self, func, ips):
+        # calls func(SoCo) for all players at once, returns the ips that did not
+        # answer (or failed) within action_timeout seconds
+        futures = { self.executor.submit(func, self.soco(ip)): ip for ip in ips }
+        done, not_done = concurrent.futures.wait(futures, timeout=self.action_timeout)
+
+        failed = [ futures[f] for f in not_done ]
+
+        for f in done:
+            if f.exception():
+                log.error('sonos player {} failed: {}'.format(futures[f], f.exception()))
+                failed.append(futures[f])
+
+        if not_done:
+            log.error('sonos players {} did not answer within {}s'.format([ futures[f] for f in not_done ], self.action_timeout))
+
+        return failed
+
+    def get(self):
+        self.start()
+
+        # only the very first call has to wait for discovery
+        if not self.updated:
+            self.refreshed.wait(self.discover_timeout + 1)
+
+        return self
+
+def sonosTopology():
+    # sonos:
+    #   ttl: seconds between two discoveries
+    #   discover_timeout: seconds to wait for players to answer
+    #   action_timeout: max seconds an action waits for the players
+    #
+    # one topology per process, it is replaced when the settings change
+    config = Config().get('sonos', {})
+    settings = (config.get('ttl', 60), config.get('discover_timeout', 5), config.get('action_timeout', 2))
+
+    topology = processInstance('sonos_topology', settings, lambda: SonosTopology(*settings), lambda old, new: new.takeOver(old))
+
+    return topology.get()
+
+##
+# Graphite
+##
+
+render_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'coalesced': 0,
+    'evictions': 0,
+}
+
+class RenderCache():
+    # LRU + TTL cache for graphite renders. concurrent requests for the same key
+    # wait for the one upstream fetch instead of starting their own.
+    def __init__(self, max_entries=128, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+
+        if not entry or entry['expires'] <= time.monotonic():
+            return None
+
+        self.entries.move_to_end(key)
+
+        return entry
+
+    def get(self, key, fetch):
+        # fetch() returns (content_type, body) or None if the render failed
+        while True:
+            with self.lock:
+                entry = self.lookup(key)
+
+                if entry:
+                    render_cache_stats['hits'] += 1
+                    return entry
+
+                event = self.inflight.get(key)
+
+                if not event:
+                    self.inflight[key] = threading.Event()
+                    break
+
+            render_cache_stats['coalesced'] += 1
+            event.wait(self.ttl)
+
+        render_cache_stats['misses'] += 1
+        entry = None
+
+        try:
+            result = fetch()
+
+            if result:
+                content_type, body = result
+                entry = {
+                    'content_type': content_type,
+                    'body': body,
+                    'etag': hashlib.sha1(body).hexdigest(),
+                    'expires': time.monotonic() + self.ttl,
+                }
+        finally:
+            with self.lock:
+                if entry:
+                    self.entries[key] = entry
+                    self.entries.move_to_end(key)
+
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                        render_cache_stats['evictions'] += 1
+
+                self.inflight.pop(key).set()
+
+        return entry
+
+def renderCache():
+    # metrics:
+    #   render_cache:
+    #     ttl: seconds a render is served from memory
+    #     max_entries: number of cached renders
+    #
+    # one cache per process, it is replaced (and the renders dropped) when the settings change
+    config = Config()['metrics'].get('render_cache', {})
+    settings = (config.get('max_entries', 128), config.get('ttl', 60))
+
+    return processInstance('render_cache', settings, lambda: RenderCache(*settings))
+
+class MetricCatalog():
+    # metric names per device from graphite /metrics/find. outdated lists are
+    # served while a background thread fetches them again, when graphite is not
+    # reachable the last known list stays in use.
+    def __init__(self, ttl=300, retry=10):
+        self.ttl = ttl
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.refreshing = set()
+        self.inflight = {}
+
+    def fetch(self, device):
+        config = Config()
+        url = "{}/metrics/find?query={}.{}.*".format(
+            config['metrics']['render_api_base_url'],
+            config['metrics']['prefix'],
+            device
+        )
+
+        try:
+            r = httpPool().get(url)
+        except requests.RequestException as e:
+            log.error('graphite metrics/find failed ({}): {}'.format(e, url))
+            return None
+
+        if r.status_code != 200:
+            log.error('graphite metrics/find failed ({}): {}'.format(r.status_code, url))
+            return None
+
+        # e.g. an html error page of a proxy in front of graphite
+        try:
+            return [ m['text'] for m in r.json() ]
+        except (ValueError, TypeError, KeyError) as e:
+            log.error('graphite metrics/find returned an invalid response ({}): {}'.format(e, url))
+            return None
+
+    def refresh(self, device):
+        try:
+            metrics = self.fetch(device)
+        finally:
+            with self.lock:
+                self.refreshing.discard(device)
+
+        with self.lock:
+            entry = self.entries.get(device)
+
+            if metrics is not None:
+                self.entries[device] = (metrics, time.monotonic(), True)
+
+            elif entry:
+                # failed again, keep the list and retry later
+                self.entries[device] = (entry[0], time.monotonic(), entry[2])
+
+            else:
+                self.entries[device] = ([], time.monotonic(), False)
+
+        return metrics
+
+    def first(self, device):
+        # concurrent first requests of a device wait for one fetch
+        with self.lock:
+            if device in self.entries:
+                return self.entries[device]
+
+            event = self.inflight.get(device)
+
+            if not event:
+                self.inflight[device] = threading.Event()
+
+        if event:
+            event.wait(self.retry)
+            return self.entries.get(device)
+
+        try:
+            self.refresh(device)
+        finally:
+            with self.lock:
+                self.inflight.pop(device).set()
+
+        return self.entries.get(device)
+
+    def get(self, device):
+        # returns None if the metrics were never fetched successfully.
+        # device must be checked against the config, every name gets an entry
+        entry = self.entries.get(device) or self.first(device)
+
+        if not entry:
+            return None
+
+        metrics, fetched, ok = entry
+        age = time.monotonic() - fetched
+
+        if age > (self.ttl if ok else self.retry):
+            with self.lock:
+                if device not in self.refreshing:
+                    self.refreshing.add(device)
+                    threading.Thread(target=self.refresh, args=(device,), name='metric-catalog', daemon=True).start()
+
+        if not ok:
+            return None
+
+        return metrics
+
+def metricCatalog():
+    # metrics:
+    #   catalog_ttl: seconds until the metric list of a device is fetched again
+    #
+    # one catalog per process, a new ttl keeps the fetched lists
+    config = Config()['metrics']
+    ttl = config.get('catalog_ttl', 300)
+
+    catalog = processInstance('metric_catalog', None, lambda: MetricCatalog(ttl))
+    catalog.ttl = ttl
+
+    return catalog
+
+##
+# MQTT
+##
+
+mqtt_stats = {
+    'published': 0,
+    'confirmed': 0,
+    'failed': 0,
+    'latency_last': 0,
+    'latency_max': 0,
+    'latency_total': 0,
+}
+
+class MqttPublisher():
+    # one long lived, auto reconnecting broker connection per process. publish()
+    # only queues the message, the paho network thread sends it.
+    def __init__(self, server, port, keepalive=60):
+        self.server = server
+        self.port = port
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.early = set()
+
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        self.client.connect_async(server, port, keepalive)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        log.info('mqtt publisher connected to {}:{} with result code {}'.format(self.server, self.port, rc))
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            log.error('mqtt publisher lost connection to {}:{} ({}), reconnecting'.format(self.server, self.port, rc))
+
+    def on_publish(self, client, userdata, mid):
+        # called from the paho network thread, possibly before publish() returned the mid
+        with self.lock:
+            entry = self.inflight.pop(mid, None)
+
+            if not entry:
+                self.early.add(mid)
+                return
+
+        self.confirmed(*entry)
+
+    def confirmed(self, start, event):
+        latency = time.monotonic() - start
+
+        mqtt_stats['confirmed'] += 1
+        mqtt_stats['latency_last'] = latency
+        instrumentation.observe('homeauto_mqtt_publish_duration_seconds', latency)
+        mqtt_stats['latency_total'] += latency
+        mqtt_stats['latency_max'] = max(mqtt_stats['latency_max'], latency)
+
+        event.set()
+
+    def publish(self, topic, payload, qos=1, wait=False, timeout=5):
+        start = time.monotonic()
+        event = threading.Event()
+
+        info = self.client.publish(topic, payload, qos=qos)
+
+        # qos > 0 messages stay queued in paho while there is no connection
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+            mqtt_stats['failed'] += 1
+            instrumentation.inc('homeauto_mqtt_publish_failures_total')
+            log.error('mqtt publish to {} failed: {}'.format(topic, mqtt.error_string(info.rc)))
+            return False
+
+        mqtt_stats['published'] += 1
+
+        with self.lock:
+            if info.mid in self.early:
+                self.early.discard(info.mid)
+                early = True
+            else:
+                self.inflight[info.mid] = (start, event)
+                early = False
+
+        if early:
+            self.confirmed(start, event)
+
+        if wait and not event.wait(timeout):
+            log.error('mqtt publish to {} not confirmed after {}s'.format(topic, timeout))
+            return False
+
+        return True
+
+    def queueDepth(self):
+        return len(self.inflight)
+
+    def flush(self, timeout=5):
+        # give queued messages a chance to leave before the process exits
+        deadline = time.monotonic() + timeout
+
+        while self.inflight and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        return not self.inflight
+
+    def close(self):
+        self.flush()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+def mqttPublisher():
+    config = Config()
+    settings = (config['zigbee2mqtt']['server'], config['zigbee2mqtt']['port'])
+
+    def create():
+        publisher = MqttPublisher(*settings)
+        atexit.register(publisher.flush)
+
+        return publisher
+
+    def replaced(old, new):
+        # queued messages of the old connection still get their chance to leave
+        threading.Thread(target=old.close, name='mqtt-close', daemon=True).start()
+
+    return processInstance('mqtt_publisher', settings, create, replaced)
+
+def mqttStats():
+    stats = dict(mqtt_stats)
+    stats['queue_depth'] = sum(p.queueDepth() for p in processInstances('mqtt_publisher').values())
+
+    return stats
+
+##
+# State events
+##
+
+state_event_stats = {
+    'published': 0,
+    'dropped': 0,
+}
+
+class StateEvents():
+    # state changes recorded by Device.updateData() are sent as json datagrams
+    # to the local listeners, e.g. worker_graphite. sending never blocks and it
+    # does not matter if nobody is listening.
+    #
+    # state_events:
+    #   listeners:
+    #     metrics: 127.0.0.1:8701
+    def __init__(self, listeners):
+        self.listeners = []
+
+        for address in listeners.values():
+            host, port = address.rsplit(':', 1)
+            self.listeners.append((host, int(port)))
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def publish(self, device, fields):
+        event = {
+            'device': device.name,
+            'type': device.__dict__.get('type'),
+            'fields': fields,
+            'timestamp': time.time(),
+        }
+
+        try:
+            data = json.dumps(event).encode()
+        except (TypeError, ValueError) as e:
+            log.error('{} - state event not serializable: {}'.format(device.name, e))
+            return
+
+        for listener in self.listeners:
+            try:
+                self.sock.sendto(data, listener)
+                state_event_stats['published'] += 1
+            except OSError:
+                state_event_stats['dropped'] += 1
+
+def stateEventListeners():
+    default = {
+        'metrics': '127.0.0.1:8701',
+        'api': '127.0.0.1:8702',
+    }
+
+    return Config().get('state_events', {}).get('listeners', default)
+
+def stateEvents():
+    listeners = stateEventListeners()
+
+    return processInstance('state_events', tuple(sorted(listeners.items())), lambda: StateEvents(listeners))
+
+def stateEventSocket(name):
+    # bound socket of the listener <name>, recv() returns one json encoded event
+    host, port = stateEventListeners()[name].rsplit(':', 1)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    sock.bind((host, int(port)))
+
+    return sock
+
+# seconds until a process retries to bind a listener which another process holds
+STATE_EVENT_RETRY = 30
+
+class StateEventHub():
+    # one thread reads the socket of a listener and hands every event to the
+    # queues of all subscribers, subscribers block on their queue.
+    #
+    # only one process can bind a listener. with several app processes (e.g.
+    # gunicorn workers) the others have no events, subscribe() returns None
+    # there and retries the bind every STATE_EVENT_RETRY seconds, so another
+    # process takes over when the listening one exits.
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        self.failed_at = 0
+        self.sequence = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+
+            if self.thread is False and time.monotonic() - self.failed_at < STATE_EVENT_RETRY:
+                return
+
+            try:
+                sock = stateEventSocket(self.name)
+            except OSError as e:
+                # e.g. another process of the same app already listens
+                if self.thread is None:
+                    log.error('state event listener {} could not be started: {}'.format(self.name, e))
+
+                self.thread = False
+                self.failed_at = time.monotonic()
+                return
+
+            self.thread = threading.Thread(target=self.run, args=(sock,), name='state-events', daemon=True)
+            self.thread.start()
+
+    def run(self, sock):
+        while True:
+            try:
+                event = json.loads(sock.recv(65536))
+            except ValueError:
+                continue
+
+            self.sequence += 1
+            event['id'] = self.sequence
+
+            for q in list(self.subscribers):
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    self.dropped += 1
+
+    def subscribe(self, maxsize=1000):
+        # None if this process does not receive the events of the listener
+        self.start()
+
+        if not self.thread:
+            return None
+
+        q = queue.Queue(maxsize)
+
+        with self.lock:
+            self.subscribers.add(q)
+
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def stats(self):
+        return {
+            'listening': bool(self.thread),
+            'subscribers': len(self.subscribers),
+            'events': self.sequence,
+            'dropped': self.dropped,
+        }
+
+def stateEventHub(name):
+    return processInstance('state_event_hub.' + name, None, lambda: StateEventHub(name))
+
+def stateEventStats():
+    stats = dict(state_event_stats)
+    stats['hubs'] = { hub.name: hub.stats() for hub in processInstances('state_event_hub.').values() }
+
+    return stats
+
+@instrumentation.collector
+def stateEventSamples():
+    samples = [
+        ('homeauto_state_events_published_total', {}, state_event_stats['published']),
+        ('homeauto_state_events_dropped_total', {}, state_event_stats['dropped']),
+    ]
+
+    for hub in processInstances('state_event_hub.').values():
+        samples.append(('homeauto_state_event_subscriber_drops_total', { 'listener': hub.name }, hub.dropped))
+
+    return samples
+
+##
+# Metrics
+##
+
+# fields shipped to graphite per device type, nested fields are separated by a dot.
+# metrics.schemas in the config extends/overwrites these, a device can list its
+# own fields with metrics: [ field, ... ] instead of metrics: true
+METRIC_SCHEMAS = {
+    'default': [ 'last_update.unix' ],
+    'ikea_lamp': [ 'brightness', 'color_temp', 'linkquality', 'last_update.unix' ],
+    'ikea_switch': [ 'linkquality', 'last_update.unix' ],
+    'ikea_button': [ 'battery', 'linkquality', 'voltage', 'last_update.unix' ],
+    'zigbee_log': [ 'battery', 'humidity', 'pressure', 'temperature', 'illuminance', 'co2', 'voltage', 'linkquality', 'last_update.unix' ],
+    'lora_log': [ 'temperature', 'humidity', 'BatV', 'last_update.unix' ],
+    'mystrom_switch': [ 'power', 'Ws', 'relay', 'temperature', 'last_update.unix' ],
+    'volumio': [ 'volume', 'last_update.unix' ],
+    'sonos': [ 'volume', 'last_update.unix' ],
+    'fingerbot': [ 'battery', 'linkquality', 'last_update.unix' ],
+}
+
+def metricFields(data):
+    # data: device config or device state, needs the type and metrics keys
+    if type(data.get('metrics')) in (list, tuple):
+        return data['metrics']
+
+    schemas = dict(METRIC_SCHEMAS)
+    schemas.update(Config()['metrics'].get('schemas', {}))
+
+    return schemas.get(data.get('type'), schemas['default'])
+
+def metricValues(name, data, fields):
+    # numeric values of the schema fields, booleans as 0/1, missing fields are skipped
+    values = {}
+
+    for field in fields:
+        value = data
+
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+
+        if type(value) == bool:
+            value = int(value)
+
+        if type(value) not in (int, float):
+            continue
+
+        values[name + '.' + field] = value
+
+    return values
 
 ##
 # Device loading
@@ -138,13 +1616,267 @@ def loadDevices(com_type=None):
 
     return devices, filtered
 
+##
+# Device registry
+##
+
+class DeviceRegistry():
+    # long lived device objects for one process. devices are constructed once
+    # (without touching the network) and only re-read from the store when their
+    # stored state changed. everything is rebuilt after a config change.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.config = None
+        self.devices = {}
+        self.versions = {}
+        self.indexes = {}
+        self.names_by_type = {}
+
+    def sync(self):
+        config = Config()
+
+        if config is self.config:
+            return config
+
+        with self.lock:
+            if config is not self.config:
+                self.devices = {}
+                self.versions = {}
+                self.indexes = {}
+                self.names_by_type = {}
+                self.config = config
+
+        return config
+
+    def get(self, name, refresh=False):
+        config = self.sync()
+
+        if name not in config['devices']:
+            log.error('device {} not found in config!'.format(name))
+            return False
+
+        with self.lock:
+            device = self.devices.get(name)
+            version = stateVersion(name)
+
+            if not device:
+                device = getDeviceClass(config['devices'][name]['type'])(name)
+                self.devices[name] = device
+
+            elif version != self.versions.get(name):
+                device.load()
+
+            self.versions[name] = version
+
+        if refresh:
+            self.refresh(device)
+
+        device.checkOutdated()
+
+        return device
+
+    def wrote(self, device, version):
+        # called after a resident device flushed itself, its own write is no reason to reload it
+        with self.lock:
+            if self.devices.get(device.name) is device:
+                self.versions[device.name] = version
+
+    def names(self, com_type=None):
+        # names of the devices of one com_type, determined once per config
+        config = self.sync()
+
+        if not com_type:
+            return list(config['devices'].keys())
+
+        if com_type not in self.names_by_type:
+            names = [ name for name in config['devices'].keys() if self.get(name).com_type == com_type ]
+
+            with self.lock:
+                if config is self.config:
+                    self.names_by_type[com_type] = names
+
+            return names
+
+        return self.names_by_type[com_type]
+
+    def all(self, com_type=None, refresh=False):
+        # only the devices of com_type are read, others are not touched
+        return { name: self.get(name, refresh=refresh) for name in self.names(com_type) }
+
+    def index(self, key, com_type=None):
+        # lookup table <device attribute> -> device name, e.g. zigbee_id or device_id
+        config = self.sync()
+        index_key = (key, com_type)
+
+        if index_key not in self.indexes:
+            index = {}
+
+            for name, device in self.all(com_type).items():
+                value = device.__dict__.get(key)
+
+                if value is None:
+                    continue
+
+                if value in index:
+                    log.error('{} {} is used by {} and {}!'.format(key, value, index[value], name))
+                    continue
+
+                index[value] = name
+
+            with self.lock:
+                if config is self.config:
+                    self.indexes[index_key] = index
+
+            return index
+
+        return self.indexes[index_key]
+
+    def refresh(self, device):
+        # live state update, only http devices can be polled
+        if device.com_type != 'http':
+            return None
+
+        try:
+            data = device.getState()
+        except Exception as e:
+            log.error('{} - getState() failed: {}'.format(device.name, e))
+            return None
+
+        with self.lock:
+            self.versions[device.name] = stateVersion(device.name)
+
+        return data
+
+registry = DeviceRegistry()
+
+
+##
+# Scenes
+##
+
+scene_stats = {}
+
+class SceneRunner():
+    # runs scenes/<name>.py in a thread pool of the calling process. scene modules
+    # are imported once and their run(*params) function is called per execution,
+    # scripts without a run() function are started as a separate process.
+    def __init__(self, directory, workers=4, in_process=True):
+        self.directory = directory.rstrip('/')
+        self.in_process = in_process
+        self.lock = threading.Lock()
+        self.modules = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scene')
+
+    def path(self, name):
+        return '{}/{}.py'.format(self.directory, name)
+
+    def shutdown(self):
+        # scenes which are already queued still run
+        self.executor.shutdown(wait=False)
+
+    def load(self, name):
+        with self.lock:
+            if name in self.modules:
+                return self.modules[name]
+
+            spec = importlib.util.spec_from_file_location('scene_' + name, self.path(name))
+            module = importlib.util.module_from_spec(spec)
+
+            try:
+                spec.loader.exec_module(module)
+            except Exception as e:
+                log.error('scene {} could not be loaded: {}'.format(name, e))
+                module = None
+
+            self.modules[name] = module
+
+            return module
+
+    def preload(self):
+        if not self.in_process or not os.path.isdir(self.directory):
+            return
+
+        for file in sorted(os.listdir(self.directory)):
+            if file.endswith('.py'):
+                self.load(file[:-len('.py')])
+
+    def run(self, name, *params):
+        if not os.path.isfile(self.path(name)):
+            log.error('scene {} does not exist ({})'.format(name, self.path(name)))
+            return None
+
+        return self.executor.submit(self.execute, name, params)
+
+    def execute(self, name, params):
+        start = time.monotonic()
+        module = None
+        error = None
+
+        if self.in_process:
+            module = self.load(name)
+
+        try:
+            if module and hasattr(module, 'run'):
+                module.run(*params)
+            else:
+                subprocess.Popen([ sys.executable, self.path(name) ] + [ str(p) for p in params ]).wait()
+        except Exception as e:
+            error = e
+            log.error('scene {} failed: {}'.format(name, e))
+
+        duration = time.monotonic() - start
+
+        stats = scene_stats.setdefault(name, { 'runs': 0, 'failures': 0, 'last': 0, 'max': 0, 'total': 0 })
+        stats['runs'] += 1
+        stats['last'] = duration
+        stats['max'] = max(stats['max'], duration)
+        stats['total'] += duration
+
+        if error:
+            stats['failures'] += 1
+
+        instrumentation.observe('homeauto_scene_duration_seconds', duration, scene=name, result='error' if error else 'ok')
+
+        log.info('scene {} finished in {:.1f} ms (runs: {}, avg: {:.1f} ms, max: {:.1f} ms)'.format(
+            name,
+            duration * 1000,
+            stats['runs'],
+            stats['total'] / stats['runs'] * 1000,
+            stats['max'] * 1000
+        ))
+
+        return error is None
+
+def sceneRunner():
+    # scene_runner:
+    #   workers: 4
+    #   in_process: true, false starts every scene as its own python process
+    config = Config().get('scene_runner', {})
+    directory = os.path.dirname(os.path.realpath(__file__)) + '/scenes'
+    settings = (config.get('workers', 4), config.get('in_process', True))
+
+    # one runner per process, it is replaced when the settings change
+    return processInstance(
+        'scene_runner',
+        settings,
+        lambda: SceneRunner(directory, workers=settings[0], in_process=settings[1]),
+        lambda old, new: old.shutdown()
+    )
 
 ##
 # Device Classes
 ##
 
 class Device():
+    # bookkeeping lives in slots so it is never part of __dict__, which is
+    # what gets stored and served by the api
+    __slots__ = ('__dict__', '__weakref__', '_saved', '_saved_at', '_version')
+
     def __init__(self, name, data=False):
+        self._saved = {}
+        self._saved_at = 0
+        self._version = 0
+
         self.name = name
         self.com_type = None
         self.actions = []
@@ -162,8 +1894,27 @@ class Device():
         return False, None
 
     def updateData(self, data):
+        changed = [ k for k, v in data.items() if self.__dict__.get(k, _missing) != v ]
+
         self.setLastUpdate()
         self.__dict__.update(data)
+        self._version += 1
+
+        state_stats['updates'] += 1
+
+        # drivers also assign fields directly (self.online = ...), those only show up against the store
+        if not changed:
+            changed = [ k for k in self.dirtyFields() if k != 'last_update' ]
+
+        # same payload as before: only keep last_update fresh in the store every heartbeat seconds
+        if not changed and time.time() - self._saved_at < self.heartbeat():
+            state_stats['writes_avoided'] += 1
+            return
+
+        fields = { k: self.__dict__[k] for k in changed }
+        fields['last_update'] = self.last_update
+
+        stateEvents().publish(self, fields)
 
         self.save()
 
@@ -174,56 +1925,120 @@ class Device():
         self.last_update['unix'] = time.mktime(now)
         self.last_update['human'] = time.asctime(now)
 
+    def heartbeat(self):
+        heartbeat = Config().get('state_store', {}).get('heartbeat', 60)
+
+        if self.__dict__.get('max_last_update_diff'):
+            heartbeat = min(heartbeat, self.max_last_update_diff / 2)
+
+        return heartbeat
+
+    def etag(self):
+        # changes whenever the state of this object changed or it became outdated, unique per process
+        last_update = self.__dict__.get('last_update')
+        outdated = type(last_update) == dict and last_update.get('outdated', False)
+
+        return '{}-{}-{}{}'.format(PROCESS_TOKEN, id(self), self._version, '-outdated' if outdated else '')
+
+    def stored(self, key, value):
+        # last_update.outdated is computed on every read by checkOutdated(), it is never stored
+        if key == 'last_update' and type(value) == dict and 'outdated' in value:
+            value = { k: v for k, v in value.items() if k != 'outdated' }
+
+        return value
+
+    def dirtyFields(self, data=None):
+        if data is None:
+            data = dict(self.__dict__)
+
+        return [ k for k, v in data.items() if self._saved.get(k) != json.dumps(self.stored(k, v)) ]
+
     def load(self):
         config = Config()
 
-        storage_directory = config['storage_directory']
         devices = config['devices']
-        filename = storage_directory.rstrip('/') + '/' + self.name + '.json'
+
+        # fields of a write which is still queued win over the stored ones
+        dirty = {}
+        if self._saved_at and state_writer.isPending(self):
+            dirty = { k: self.__dict__[k] for k in self.dirtyFields() }
 
         self._config = devices[self.name]
 
-        data = {}
         name = self.name
+        data = { k: self.stored(k, v) for k, v in stateStore().load(self.name).items() }
 
-        if os.path.isfile(filename):
-            with open(filename) as f:
-                data = json.load(f)
+        self._saved = { k: json.dumps(v) for k, v in data.items() }
+        self._saved_at = time.time()
 
+        data.update(dirty)
         data.update(devices[self.name])
 
         self.__dict__.update(data)
         self.name = name
+        self._version += 1
 
-        if self.__dict__.get('max_last_update_diff'):
-            now = time.mktime(time.localtime())
-            max_diff = now - data['max_last_update_diff']
+        self.checkOutdated()
 
-            if self.__dict__.get('last_update', None):
-                if self.__dict__['last_update'].get('unix', None):
-                    if self.__dict__['last_update']['unix'] < max_diff:
-                        self.__dict__['last_update']['outdated'] = True
+    def checkOutdated(self):
+        # last_update.outdated marks devices which did not report for max_last_update_diff
+        # seconds. resident devices are not reloaded while they are silent, so the
+        # registry checks this on every read.
+        max_diff = self.__dict__.get('max_last_update_diff')
+        last_update = self.__dict__.get('last_update')
 
+        if not max_diff or type(last_update) != dict or not last_update.get('unix'):
+            return False
 
-    def save(self):
-        config = Config()
+        outdated = last_update['unix'] < time.mktime(time.localtime()) - max_diff
 
-        storage_directory = config['storage_directory']
-        devices = config['devices']
-        filename = storage_directory.rstrip('/') + '/' + self.name + '.json'
+        # a new dict, a flush running in another thread may still hold the old one
+        if outdated != ('outdated' in last_update):
+            last_update = { k: v for k, v in last_update.items() if k != 'outdated' }
 
-        with open(filename, 'w') as f:
-            json.dump(self.__dict__, f)
+            if outdated:
+                last_update['outdated'] = True
+
+            self.last_update = last_update
+
+        return outdated
+
+    def save(self):
+        # queued, the state writer calls flush() after at most state_store.flush_delay seconds
+        self._version += 1
+        state_writer.schedule(self)
 
         return
 
+    def flush(self):
+        # a copy, other threads keep adding fields through updateData while this runs
+        data = { k: self.stored(k, v) for k, v in list(self.__dict__.items()) }
+        keys = self.dirtyFields(data)
+
+        if not keys:
+            state_stats['writes_avoided'] += 1
+            return False
+
+        version = stateStore().save(self.name, data, keys)
+
+        for k in keys:
+            self._saved[k] = json.dumps(data[k])
+
+        self._saved_at = time.time()
+
+        registry.wrote(self, version)
+
+        state_stats['writes_performed'] += 1
+        state_stats['fields_written'] += len(keys)
+
+        return True
+
 class Volumio(Device):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.com_type = 'http'
         self.actions = [ 'pause', 'stop', 'toggle', 'volume', 'prev', 'next', 'getState' ]
-        self.getState()
 
     def _get(self, path, fail=True):
         url = 'http://{}/{}'.format(self.address, path.lstrip('/'))
@@ -231,7 +2046,7 @@ class Volumio(Device):
         r = None
 
         try:
-            r = requests.get(url, timeout=3)
+            r = httpPool().get(url)
         except:
             error = True
 
@@ -274,9 +2089,8 @@ class Volumio(Device):
 
     def setVolume(self, volume=10):
         data = self._get('api/v1/commands/?cmd=volume&volume={}'.format(volume))
-        self.volume = volume
 
-        self.save()
+        self.updateData({ 'volume': volume })
 
         return { 'volume': volume }
 
@@ -336,8 +2150,6 @@ class Sonos(Device):
             }
         }
 
-        self.getState()
-
     def action(self, action, msg=None):
         data = {}
 
@@ -349,10 +2161,10 @@ class Sonos(Device):
             self.doToggle()
 
         if action == 'join':
-            if self.join_to is defined:
+            if self.__dict__.get('join_to'):
                 self.doJoin()
 
-            if self.join_to is not defined:
+            if not self.__dict__.get('join_to'):
                 log.error('{} is not allowed because device does not have a join_to key'.format(action))
 
         if action == 'unjoin':
@@ -371,7 +2183,7 @@ class Sonos(Device):
         return data
 
     def blink(self, player_ip, num=1):
-        player = soco.SoCo(player_ip)
+        player = sonosTopology().soco(player_ip)
         i = 0
 
         while i < num:
@@ -388,27 +2200,33 @@ class Sonos(Device):
             self.doJoin()
 
     def doJoin(self):
-        player = soco.SoCo(self.ip)
+        topology = sonosTopology()
+        join_ip = topology.players.get(self.join_to)
+
+        if not join_ip:
+            log.error('sonos player {} not found!'.format(self.join_to))
+            return
 
-        for p in self.players:
-            join_player = soco.SoCo(p)
-            if join_player._player_name == self.join_to:
-                player.join(join_player)
-                self.joined = True
+        topology.soco(self.ip).join(topology.soco(join_ip))
+        topology.invalidate()
+        self.joined = True
 
     def doUnJoin(self):
-        player = soco.SoCo(self.ip)
-        player.unjoin()
-        self.joined = False
-        self.save()
+        topology = sonosTopology()
+        topology.soco(self.ip).unjoin()
+        topology.invalidate()
+
+        self.updateData({ 'joined': False })
 
     def doToggle(self):
+        topology = sonosTopology()
+
         for p in self.coordinators:
-            player = soco.SoCo(p)
+            player = topology.soco(p)
             state = self.transport_info['current_transport_state']
 
             if state == 'STOPPED':
-                self.blink(p, 3)
+                topology.background.submit(self.blink, p, 3)
                 player.volume = self.volume
                 player.play()
 
@@ -420,50 +2238,53 @@ class Sonos(Device):
         return { 'play_state': self.transport_info['current_transport_state'] }
 
     def setVolume(self, volume=10):
-        self.volume = volume
+        topology = sonosTopology()
 
-        for p in self.coordinators:
-            player = soco.SoCo(p)
-            player.volume = self.volume
-            self.blink(p)
+        # every player once, coordinators first
+        players = list(dict.fromkeys(list(self.coordinators) + list(self.players)))
 
-        for p in self.players:
-            player = soco.SoCo(p)
-            player.volume = self.volume
-            self.blink(p)
+        def setPlayerVolume(player):
+            player.volume = volume
 
-        self.save()
+        failed = topology.fanOut(setPlayerVolume, players)
+
+        # confirmation blink, the request does not wait for it
+        for p in players:
+            if p not in failed:
+                topology.background.submit(self.blink, p)
+
+        self.updateData({ 'volume': volume })
+
+        if failed:
+            return { 'volume': volume, 'failed': failed }
 
         return { 'volume': volume }
 
     def getState(self):
         data = { 'online': True }
-        zones = soco.discover()
+        topology = sonosTopology()
 
-        if not zones:
+        if not topology.players:
             data = { 'online': False }
             log.error('No sonos controller found!')
 
-        if zones:
-            self.players = []
-            self.coordinators = []
-
-            for z in zones:
-                self.players.append(z.ip_address)
+        if topology.players:
+            # passed to updateData, so the changes are written and published
+            data['players'] = sorted(topology.players.values())
+            data['coordinators'] = []
 
-                # skip player if it is not the zone we want
-                if z._player_name != self.player_name:
-                    continue
+            ip = topology.players.get(self.player_name)
 
-                if not z._is_coordinator:
-                    self.joined = True
+            if ip:
+                player = topology.soco(ip)
 
-                self.ip = z.ip_address
-                self.transport_info = z.get_current_transport_info()
+                data['ip'] = ip
+                data['joined'] = ip not in topology.coordinators
+                data['transport_info'] = player.get_current_transport_info()
 
-                if z._is_coordinator:
-                    self.coordinators.append(z.ip_address)
-                    self.volume = z.volume
+                if not data['joined']:
+                    data['coordinators'].append(ip)
+                    data['volume'] = player.volume
 
         self.updateData(data)
         return data
@@ -495,8 +2316,6 @@ class MyStromSwitch(Device):
             }
         }
 
-        self.getState()
-
     def action(self, action, msg=None):
         if action not in self.actions.keys():
             log.error('{} is not allowed ({})'.format(action, str(self.actions.keys())))
@@ -511,7 +2330,11 @@ class MyStromSwitch(Device):
         return data
 
     def getState(self):
-        r = requests.get('http://{}/report'.format(self.address))
+        try:
+            r = httpPool().get('http://{}/report'.format(self.address))
+        except requests.RequestException as e:
+            log.error('http request to {} failed: {}'.format(self.address, e))
+            return None
 
         if r.status_code != 200:
             log.error('http request not 200: {} - '.format(str(r.status_code), str(r.text)))
@@ -539,13 +2362,18 @@ class MyStromSwitch(Device):
             path = '/relay?state=0'
 
         url = 'http://{}'.format(self.address) + path
-        r = requests.get(url)
+
+        try:
+            r = httpPool().get(url)
+        except requests.RequestException as e:
+            log.error('http request to {} failed: {}'.format(url, e))
+            return None
 
         if r.status_code != 200:
             log.error('http request not 200: {} - '.format(str(r.status_code), str(r.text)))
             return None
 
-        _, data = self.getState()
+        data = self.getState()
 
         return data
 
@@ -583,18 +2411,18 @@ class ZigBeeDevice(Device):
     def receiveMsg(self, data):
         self.updateData(data)
 
-    def sendMsg(self, msg, topic_suffix='/set'):
+    def sendMsg(self, msg, topic_suffix='/set', wait=None):
+        # zigbee2mqtt:
+        #   qos: 1 (default), messages are queued while the broker is not reachable
+        #   confirm: false (default), wait for the broker to acknowledge every message
         config = Config()
-        server = config['zigbee2mqtt']['server']
-        topic = config['zigbee2mqtt']['topic'] + '/' + self.zigbee_id + topic_suffix
+        zigbee2mqtt = config['zigbee2mqtt']
+        topic = zigbee2mqtt['topic'] + '/' + self.zigbee_id + topic_suffix
 
-        client = mqtt.Client()
-        client.connect(config['zigbee2mqtt']['server'], config['zigbee2mqtt']['port'], 60)
+        if wait is None:
+            wait = zigbee2mqtt.get('confirm', False)
 
-        sent_msg = client.publish(topic, json.dumps(msg))
-        sent_msg.wait_for_publish()
-
-        return True
+        return mqttPublisher().publish(topic, json.dumps(msg), qos=zigbee2mqtt.get('qos', 1), wait=wait)
 
 class ZigBeeLogDevice(ZigBeeDevice):
     def receiveMsg(self, data):
@@ -608,17 +2436,15 @@ class ZigBeeActionDevice(ZigBeeDevice):
         super().__init__(*args, **kwargs)
 
     def receiveMsg(self, data):
-        config = Config()
         self.action = data.get('action', None)
 
         if not self.action:
             return False
 
         timestamp = time.time()
-        self.action_history.insert(0, { "action": self.action, "timestamp": timestamp })
+        action_history = [ { "action": self.action, "timestamp": timestamp } ] + list(self.action_history)
 
-        if len(self.action_history) > 10:
-            self.action_history = self.action_history[:10]
+        self.action_history = action_history[:10]
 
         self.scene = self.scenes.get(self.action)
 
@@ -628,17 +2454,14 @@ class ZigBeeActionDevice(ZigBeeDevice):
 
         if type(self.scene) == str:
             log.info("calling scene: {}".format(self.scene))
-            _p = subprocess.Popen([ sys.executable, "scenes/{}.py".format(self.scene) ])
+            sceneRunner().run(self.scene)
 
-        if type(self.scene) == list:
+        if type(self.scene) in (list, tuple):
             log.info("calling scene: {} with params {}".format(self.scene[0], self.scene[1:]))
-            cmd = self.scene
-            cmd[0] = "scenes/{}.py".format(self.scene[0])
-            cmd.insert(0, sys.executable)
-
-            _p = subprocess.Popen(cmd)
+            sceneRunner().run(self.scene[0], *self.scene[1:])
 
-        self.updateData(data)
+        # action_history is passed along so a repeated action is not seen as unchanged
+        self.updateData(dict(data, action_history=self.action_history))
 
 
 class Fingerbot(ZigBeeDevice):
@@ -884,8 +2707,7 @@ class IkeaLamp(IkeaSwitch):
 
             return False, error
 
-        self.color_temp = data
-        msg = { 'color_temp': self.color_temp, 'transition': transition  }
+        msg = { 'color_temp': data, 'transition': transition  }
         send = self.sendMsg(msg)
 
         if not send:
@@ -1,46 +1,238 @@
+import json
 import time
+import pickle
+import socket
+import struct
 import graphyte
 
 from utils import *
 
 config = Config()
+installSignalHandlers()
+exposeMetrics('worker_graphite')
 
-graphyte.init(config['metrics']['server'], prefix=config['metrics']['prefix'])
-log.info('connected to graphite server : ' + config['metrics']['server'])
+class GraphiteBatch():
+    # collects metrics in memory and ships them over one long lived connection.
+    # while graphite is not reachable the metrics are kept (up to max_pending)
+    # and the connection is only tried again after retry seconds.
+    #
+    # metrics:
+    #   protocol: plaintext (default, port 2003) or pickle (port 2004)
+    #   port: graphite port
+    def __init__(self, server, prefix, protocol='plaintext', port=None, timeout=5, retry=10, max_pending=100000):
+        self.protocol = protocol
+        self.prefix = prefix
+        self.timeout = timeout
+        self.retry = retry
+        self.max_pending = max_pending
+        self.metrics = []
+        self.since = 0
+        self.sock = None
+        self.retry_at = 0
 
-all_devices, _ = loadDevices()
-devices = {}
+        if not port:
+            port = 2004 if protocol == 'pickle' else 2003
 
-for d in all_devices:
-    if all_devices[d].__dict__.get('metrics'):
-        devices[d] = all_devices[d]
+        self.address = (server, port)
+        self.sender = graphyte.Sender(server, port=port, prefix=prefix)
+
+    def add(self, name, value, timestamp):
+        if not self.metrics:
+            self.since = time.monotonic()
+
+        self.metrics.append((name, value, timestamp))
+
+    def message(self):
+        if self.protocol == 'pickle':
+            data = [ (self.prefix + '.' + name, (int(timestamp), value)) for name, value, timestamp in self.metrics ]
+            payload = pickle.dumps(data, protocol=2)
+
+            return struct.pack('!L', len(payload)) + payload
+
+        return b''.join(self.sender.build_message(name, value, timestamp) for name, value, timestamp in self.metrics)
+
+    def connect(self):
+        if self.sock:
+            return self.sock
+
+        if time.monotonic() < self.retry_at:
+            return None
+
+        try:
+            self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        except OSError as e:
+            log.error('graphite {}:{} not reachable, retrying in {}s: {}'.format(*self.address, self.retry, e))
+            self.retry_at = time.monotonic() + self.retry
+            return None
+
+        return self.sock
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, message):
+        # graphite closes idle connections, a failed send is tried once more on a new one
+        for attempt in range(2):
+            sock = self.connect()
+
+            if not sock:
+                return False
+
+            try:
+                sock.sendall(message)
+                return True
+            except OSError as e:
+                log.error('sending metrics to graphite failed: {}'.format(e))
+                self.close()
+
+        self.retry_at = time.monotonic() + self.retry
+
+        return False
+
+    def flush(self):
+        if not self.metrics:
+            return 0
+
+        count = len(self.metrics)
+
+        if not self.send(self.message()):
+            if count > self.max_pending:
+                log.error('graphite not reachable, dropping {} metrics'.format(count - self.max_pending))
+                del self.metrics[:-self.max_pending]
+
+            return 0
+
+        self.metrics = []
+
+        return count
+
+batch = GraphiteBatch(
+    config['metrics']['server'],
+    config['metrics']['prefix'],
+    protocol=config['metrics'].get('protocol', 'plaintext'),
+    port=config['metrics'].get('port'),
+    retry=config['metrics'].get('retry', 10)
+)
+log.info('shipping metrics to graphite server : ' + config['metrics']['server'])
+
+# state changes are pushed by Device.updateData(), see StateEvents
+events = stateEventSocket('metrics')
+
+# metric name -> (value, unix time it was last sent)
+last_sent = {}
+
+# device name -> unix time of the last update, for the last_received metric
+last_update = {}
+
+def metricDevices():
+    return { name: c for name, c in Config()['devices'].items() if c.get('metrics') }
+
+def add(metric, value, timestamp, force=False):
+    sent = last_sent.get(metric)
+
+    # unchanged values are repeated by tick() every heartbeat seconds
+    if not force and sent and sent[0] == value:
+        return
+
+    batch.add(metric, value, timestamp)
+    last_sent[metric] = (value, timestamp)
+
+def receive(data):
+    try:
+        event = json.loads(data)
+    except ValueError:
+        log.error('received invalid state event: {}'.format(data))
+        return
+
+    name = event['device']
+    device_config = metricDevices().get(name)
+
+    if not device_config:
+        return
+
+    for metric, value in metricValues(name, event['fields'], metricFields(device_config)).items():
+        add(metric, value, event['timestamp'])
+
+    if type(event['fields'].get('last_update')) == dict:
+        last_update[name] = event['fields']['last_update'].get('unix', last_update.get(name))
+
+def tick(now):
+    heartbeat = Config()['metrics'].get('heartbeat', 300)
+
+    for name in metricDevices():
+        if last_update.get(name):
+            add(name + '.last_received', now - last_update[name], now, force=True)
+        else:
+            add(name + '.last_received', 0, now, force=True)
+
+    for metric, (value, sent_at) in list(last_sent.items()):
+        if now - sent_at >= heartbeat:
+            add(metric, value, now, force=True)
+
+def flush():
+    count = batch.flush()
+
+    if count:
+        log.info('sent {} metrics'.format(count))
+
+# events only carry changes, start with everything that is in the store
+now = time.time()
+
+for name in metricDevices():
+    device = registry.get(name)
+
+    for metric, value in metricValues(name, device.__dict__, metricFields(device.__dict__)).items():
+        add(metric, value, now)
+
+    if type(device.__dict__.get('last_update')) == dict:
+        last_update[name] = device.last_update.get('unix')
+
+tick(now)
+flush()
+
+next_tick = now + config['metrics']['timeout']
 
 # loop
 while True:
-    for d in devices:
-        data = loadDevice(d)
+    # metrics:
+    #   flush_interval: max seconds a state change waits for more changes
+    #   batch_size: metrics which are sent without waiting any longer
+    flush_interval = Config()['metrics'].get('flush_interval', 1)
+    batch_size = Config()['metrics'].get('batch_size', 1000)
+
+    timeout = next_tick - time.time()
+
+    if timeout <= 0:
+        tick(time.time())
+        flush()
+
+        next_tick = time.time() + Config()['metrics']['timeout']
+        continue
 
-        key_list = ['last_received']
-        for k in data.__dict__.keys():
-            key_list.append(k)
+    if batch.metrics:
+        # not before graphite is tried again, the metrics wait in the batch
+        wait = max(batch.since + flush_interval, batch.retry_at) - time.monotonic()
 
-        for k in key_list:
-            if k == 'last_received' or type(data.__dict__[k]) == int or type(data.__dict__[k]) == float:
-                name = data.name + '.' + k
+        if wait <= 0 or (len(batch.metrics) >= batch_size and batch.retry_at <= time.monotonic()):
+            flush()
+            continue
 
-                if k == 'last_received':
-                    now = time.localtime()
-                    unix_now = time.mktime(now)
+        timeout = min(timeout, wait)
 
-                    try:
-                        value = unix_now - data.last_update['unix']
-                    except:
-                        value = 0
+    events.settimeout(timeout)
 
-                if k != 'last_received':
-                    value = data.__dict__[k]
+    try:
+        receive(events.recv(65536))
+    except socket.timeout:
+        continue
 
-                graphyte.send(name, value)
-                log.info('sendet metrics for : ' + name + ' value: ' + str(value))
+    # everything else that already arrived goes into the same batch
+    events.setblocking(False)
 
-    time.sleep(config['metrics']['timeout'])
+    while True:
+        try:
+            receive(events.recv(65536))
+        except BlockingIOError:
+            break
@@ -1,19 +1,125 @@
 import time
+import concurrent.futures
 from utils import *
 
+installSignalHandlers()
+exposeMetrics('worker_http')
+
+# http_worker:
+#   interval: seconds between two polls of a device, per device override: poll_interval
+#   timeout: seconds after which a poll counts as failed
+#   workers: number of devices polled at the same time
 config = Config()
-devices, http_devices = loadDevices('http')
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config['http_worker'].get('workers', 8),
+    thread_name_prefix='poll'
+)
+
+inflight = {}
+next_poll = {}
+report = []
+
+def poll(name):
+    device = registry.get(name)
+    start = time.monotonic()
+    error = None
+    out = None
+
+    try:
+        out = device.getState()
+    except Exception as e:
+        error = str(e)
+
+    if not error and (not out or (type(out) == dict and out.get('online') is False)):
+        error = 'offline'
+
+    duration = time.monotonic() - start
+    instrumentation.observe('homeauto_http_poll_duration_seconds', duration, device=name, result='error' if error else 'ok')
+
+    return out, error, duration
+
+def collect(name, future, started, timeout):
+    if future.done():
+        timed_out = inflight.pop(name)[2]
+
+        # already reported as failed
+        if timed_out:
+            return
+
+        out, error, duration = future.result()
+
+    elif time.monotonic() - started > timeout:
+        # the thread can not be stopped, the device is skipped until it returns
+        if inflight[name][2]:
+            return
+
+        inflight[name] = (future, started, True)
+        out, error, duration = None, 'timeout after {}s'.format(timeout), time.monotonic() - started
+
+    else:
+        return
+
+    report.append((name, duration, error))
+
+    if error:
+        log.error('{} - getState() was not successful: {}'.format(name, error))
+        return
+
+    log.info('INFO - {} - getState(): {}'.format(name, out))
+
+def logReport():
+    if not report:
+        return
+
+    failures = [ r for r in report if r[2] ]
+    durations = sorted(r[1] for r in report)
+    slowest = max(report, key=lambda r: r[1])
+
+    pool = httpPool().stats().values()
+    requests_total = sum(p['requests'] for p in pool)
+    connections_total = sum(p['connections'] for p in pool)
+
+    log.info('poll cycle: {} polls, {} failed, latency median {:.0f} ms, max {:.0f} ms ({}), connection reuse {:.0%}{}'.format(
+        len(report),
+        len(failures),
+        durations[len(durations) // 2] * 1000,
+        slowest[1] * 1000,
+        slowest[0],
+        1 - connections_total / requests_total if requests_total else 0,
+        ', failed: ' + ', '.join(r[0] for r in failures) if failures else ''
+    ))
+
+    report.clear()
+
+cycle_end = time.monotonic()
 
 while True:
-    for d in http_devices:
-        log.info(d)
-        out = devices[d].getState()
+    config = Config()
+    interval = config['http_worker']['interval']
+    timeout = config['http_worker'].get('timeout', 5)
+    now = time.monotonic()
+
+    # names and config only, the devices are read by the poll threads
+    for name in registry.names('http'):
+        if name in inflight or next_poll.get(name, 0) > now:
+            continue
+
+        inflight[name] = (executor.submit(poll, name), now, False)
+        next_poll[name] = now + config['devices'][name].get('poll_interval', interval)
 
-        #if not e:
-        #    log.error('{} - getState() was not sucessfull'.format(d))
-        #    continue
+    for name, (future, started, timed_out) in list(inflight.items()):
+        collect(name, future, started, timeout)
 
-        log.info('INFO - {} - getState(): {}'.format(d, out))
+    if now >= cycle_end:
+        logReport()
+        cycle_end = now + interval
 
-    time.sleep(config['http_worker']['interval'])
+    # sleep until the next poll is due, a poll finished or a poll runs into its timeout
+    wake_up = list(next_poll.values()) + [ cycle_end ]
+    wake_up += [ started + timeout for _, started, timed_out in inflight.values() if not timed_out ]
 
+    concurrent.futures.wait(
+        [ f for f, _, _ in inflight.values() ],
+        timeout=max(0.01, min(wake_up) - time.monotonic()),
+        return_when=concurrent.futures.FIRST_COMPLETED
+    )
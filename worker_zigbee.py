@@ -4,40 +4,56 @@ import paho.mqtt.client as mqtt
 from utils import *
 
 config = Config()
-devices, zigbee_devices = loadDevices('zigbee')
+installSignalHandlers()
+exposeMetrics('worker_zigbee')
+
+# devices stay resident in the registry between messages
+zigbee_devices = registry.all('zigbee')
+
+# import the scene modules now, not on the first button press
+sceneRunner().preload()
 
 def on_connect(client, userdata, flags, rc):
     log.info('Connected with result code ' + str(rc))
 
-    sub_list = []
-    for d in zigbee_devices.keys():
-        sub_list.append((str(config['zigbee2mqtt']['topic'] + '/' + zigbee_devices[d].zigbee_id), 0))
+    # one wildcard subscription, messages are matched to devices in on_message
+    topic = Config()['zigbee2mqtt']['topic'] + '/#'
+    client.subscribe(topic)
 
-    client.subscribe(sub_list)
-
-    for sub in sub_list:
-        log.info('Subscribed to topic: ' + str(sub[0]))
+    log.info('Subscribed to topic: ' + topic)
 
 def on_message(client, userdata, msg):
-    zigbee_id = msg.topic.lstrip(config['zigbee2mqtt']['topic'] + '/')
+    prefix = Config()['zigbee2mqtt']['topic'] + '/'
 
-    device = None
+    if not msg.topic.startswith(prefix):
+        instrumentation.inc('homeauto_zigbee_messages_total', result='ignored')
+        return False
 
-    for d in zigbee_devices:
-        if zigbee_id == devices[d].zigbee_id:
-            device = loadDevice(d)
+    zigbee_id = msg.topic[len(prefix):]
+    name = registry.index('zigbee_id', 'zigbee').get(zigbee_id)
 
-    if not device:
-        log.error('received message without matching device. topic: {}, msg: {}'.format(msg.topic, msg.payload))
+    # bridge/*, */availability, */set and devices which are not configured
+    if not name:
+        instrumentation.inc('homeauto_zigbee_messages_total', result='ignored')
+        log.debug('ignoring message without matching device. topic: {}'.format(msg.topic))
         return False
 
-    device.receiveMsg(json.loads(msg.payload))
-    log.info('received: ' + str(msg.topic) + ' ' + str(msg.payload))
+    try:
+        data = json.loads(msg.payload)
+    except ValueError:
+        instrumentation.inc('homeauto_zigbee_messages_total', result='invalid')
+        log.error('received message which is not json. topic: {}, msg: {}'.format(msg.topic, msg.payload))
+        return False
 
-client = mqtt.Client()
-client.on_connect = on_connect
-client.on_message = on_message
+    device = registry.get(name)
+    device.receiveMsg(data)
+    instrumentation.inc('homeauto_zigbee_messages_total', result='handled')
+    log.info('received: ' + str(msg.topic) + ' ' + str(msg.payload))
 
-client.connect(config['zigbee2mqtt']['server'], config['zigbee2mqtt']['port'], 60)
-client.loop_forever()
+if __name__ == "__main__":
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
 
+    client.connect(config['zigbee2mqtt']['server'], config['zigbee2mqtt']['port'], 60)
+    client.loop_forever()